@@ -1,27 +1,38 @@
 #!/usr/bin/python3
 
 import asyncio
+import process
+import struct
+
+ALSA_TIMEOUT = 10 # seconds
+EQ_RANGE = (-48, 24) # dB, bands of the caps Eq10 plugin, the ctl plugin maps them to 0-100
 
 async def alsactl_store():
     # https://man.archlinux.org/man/alsactl.1.en#L,
     program = [ 'alsactl', '-L', 'store' ]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-        return stdout
+    result = await process.run(program, timeout=ALSA_TIMEOUT)
+    if result.ok:
+        return result.stdout
+    else:
+        print(f"error storing alsa settings: {result.error()}")
+
+async def alsactl_restore():
+    program = [ 'alsactl', '-L', 'restore' ]
+    result = await process.run(program, timeout=ALSA_TIMEOUT)
+    if result.ok:
+        return result.stdout
     else:
-        print("error storing alsa settings")
+        print(f"error restoring alsa settings: {result.error()}")
 
 async def get_equalizer(channel):
     device = f"ch{channel}_eq"
     # amixer -D ch1_eq scontents
     program = [ 'amixer', '-D', device, 'scontents' ]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-        return extract_equalizer_settings(stdout.decode())
+    result = await process.run(program, timeout=ALSA_TIMEOUT)
+    if result.ok:
+        return extract_equalizer_settings(result.stdout.decode())
     else:
-        print("error getting equalizer")
+        print(f"error getting equalizer: {result.error()}")
         return None
 
 async def set_equalizer(channel, settings):
@@ -40,12 +51,11 @@ async def set_equalizer(channel, settings):
     # amixer -D ch1_eq sset '00. 31 Hz' 66
     # amixer -D ch1_eq -s < stdin
     program = [ 'amixer', '-D', device, '-s' ]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE, stdin=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate(commands.encode())
-    if p.returncode == 0:
-        return extract_equalizer_settings(stdout.decode())
+    result = await process.run(program, input=commands.encode(), timeout=ALSA_TIMEOUT)
+    if result.ok:
+        return extract_equalizer_settings(result.stdout.decode())
     else:
-      print("error setting equalizer")
+      print(f"error setting equalizer: {result.error()}")
       return None
 
 async def set_equalizer_channel(channel, eq_channel, setting):
@@ -54,6 +64,28 @@ async def set_equalizer_channel(channel, eq_channel, setting):
     result = await set_equalizer(channel, settings)
     return result
 
+# alsaequal keeps the equalizer in a controls file (LADSPA_Control in ladspa_utils.h): length, id,
+# channels and num_controls as unsigned long, input_index and output_index as int, then per control
+# its index (unsigned long), the value of up to 16 channels (float) and type (unsigned long)
+# returns the settings like extract_equalizer_settings or None if the file is not understood
+def equalizer_settings_from_controls(data):
+    # the size of unsigned long depends on the OS the file was written on
+    for header, control in (("<4Q2i", "<Q16fQ"), ("<4I2i", "<I16fI")):
+        header_size = struct.calcsize(header)
+        control_size = struct.calcsize(control)
+        if len(data) < header_size:
+            continue
+        num_controls = struct.unpack_from(header, data)[3]
+        if num_controls < 10 or len(data) != header_size + num_controls*control_size:
+            continue
+        settings = []
+        for index in range(10):
+            value = struct.unpack_from(control, data, header_size + index*control_size)[1]
+            percent = int((value - EQ_RANGE[0])/(EQ_RANGE[1] - EQ_RANGE[0])*100)
+            settings.append(str(min(100, max(0, percent))))
+        return settings
+    return None
+
 def extract_equalizer_settings(result):
     lines = result.split("\n")
     settings = [lines[5].split()[4][1:-2],
@@ -89,12 +121,11 @@ async def get_device_volumes(device):
     # -M Use the mapped volume for evaluating the percentage representation like alsamixer, to be more natural for human ear.
     # command returs same result as the 'get' command
     program = [ 'amixer', '-D', device, '-M', 'get', 'Speaker' ]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-      return extract_volume_settings(stdout.decode())
+    result = await process.run(program, timeout=ALSA_TIMEOUT)
+    if result.ok:
+      return extract_volume_settings(result.stdout.decode())
     else:
-      print("error getting volume")
+      print(f"error getting volume: {result.error()}")
       return None
 
 async def set_channel_volume(channel, volume):
@@ -130,13 +161,12 @@ async def set_channel_volume(channel, volume):
     # -M Use the mapped volume for evaluating the percentage representation like alsamixer, to be more natural for human ear.
     # command returs same result as the 'get' command
     program = [ 'amixer', '-D', device, '-M', 'set', 'Speaker', set_volume ]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-        volumes = extract_volume_settings(stdout.decode())
+    result = await process.run(program, timeout=ALSA_TIMEOUT)
+    if result.ok:
+        volumes = extract_volume_settings(result.stdout.decode())
         return volumes[returnIndex]
     else:
-        print("error setting volume")
+        print(f"error setting volume: {result.error()}")
         return None
 
 def extract_volume_settings(result):
@@ -1,59 +1,355 @@
 #!/usr/bin/python3
 
 import asyncio
-from dotenv.main import get_key, set_key
+import datetime
+from dotenv.main import dotenv_values
+import hashlib
+import io
+import json
+import offload
 import os
+import process
+import re
+import shlex
+import shutil
+import tarfile
+import tempfile
 import time
 
+from config import cache_dir
+
 envFile = "/etc/opt/compose/.env"
+# alsaequal controls files, one per channel
+eqPath = "/etc/opt/eq"
 
 backupFiles = [
     '/etc/opt/compose/.env',
     '/etc/opt/squeezelite',
-    '/etc/opt/eq',
+    eqPath,
     '/var/lib/alsa/asound.state'
 ]
 
-backupTempName = "/tmp/backup.tar.gz"
+# local manifest of the last uploaded backup, the same manifest is stored in each archive
+manifestFile = f"{cache_dir}/backup.json"
+manifestMember = "backup-manifest.json"
 
-async def create_local_backup():
-    program = [ 'tar', '-czf', backupTempName ] + backupFiles
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-        out = stdout.decode()
-        if "removing leading '/' from member names" not in out:
-            print(out)
-    else:
-        print("error")
-
-async def copy_backup_to_remote():
-    remoteHost = get_key(envFile, "BACKUP_SSH_USER") + "@" + get_key(envFile, "BACKUP_SSH_HOST")
-    remoteFileName = get_key(envFile, "BACKUP_SSH_FOLDER") + "/" + time.strftime("%Y%m%d-%H%M%S") + ".tar.gz"
-    program = [ 'sshpass', '-p', get_key(envFile, "BACKUP_SSH_PASSWORD"),
-        'scp', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null',
-        '-P', get_key(envFile, "BACKUP_SSH_PORT"), backupTempName, remoteHost + ":" + remoteFileName]
-    p = await asyncio.create_subprocess_exec(*program, stdout=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode == 0:
-        out = stdout.decode()
-        if "Permanently added" not in out:
-            print(out)
-    else:
-        print("error")
+controlPath = "/tmp/ssh-backup-%C"
+CONTROL_PERSIST = 60 # seconds
+UPLOAD_TIMEOUT = 10*60 # seconds
+REMOTE_TIMEOUT = 60 # seconds
+
+_ARCHIVE_NAME = re.compile(r"^(\d{8})-\d{6}\.tar\.gz$")
+
+settingKeys = ["BACKUP_SSH_HOST", "BACKUP_SSH_PORT", "BACKUP_SSH_USER", "BACKUP_SSH_PASSWORD", "BACKUP_SSH_FOLDER"]
+
+# returns the BACKUP_SSH_* values or None if any of them is not set
+def read_settings():
+    values = dotenv_values(envFile)
+    settings = { key: values.get(key) for key in settingKeys }
+    if not all(settings.values()):
+        return None
+    return settings
+
+# the env file is read once per operation on the offload executor
+async def get_settings():
+    return await offload.run("read_config", read_settings)
+
+def ssh_program(settings, remote_command):
+    # password is passed in the environment (sshpass -e) so that it does not show up in the process list
+    remoteHost = settings["BACKUP_SSH_USER"] + "@" + settings["BACKUP_SSH_HOST"]
+    program = [ 'sshpass', '-e',
+        'ssh', '-o', 'StrictHostKeyChecking=no', '-o', 'UserKnownHostsFile=/dev/null', '-o', 'LogLevel=ERROR',
+        # consecutive commands (upload, list, prune) reuse one authenticated connection
+        '-o', 'ControlMaster=auto', '-o', f'ControlPath={controlPath}', '-o', f'ControlPersist={CONTROL_PERSIST}',
+        '-p', settings["BACKUP_SSH_PORT"], remoteHost, remote_command]
+    env = os.environ | { "SSHPASS": settings["BACKUP_SSH_PASSWORD"] }
+    return program, env
+
+def remote_write_command(remoteFileName):
+    return f"cat > {shlex.quote(remoteFileName)}"
+
+def backup_target(settings):
+    return (settings["BACKUP_SSH_USER"] + "@" + settings["BACKUP_SSH_HOST"] + ":"
+        + settings["BACKUP_SSH_PORT"] + ":" + settings["BACKUP_SSH_FOLDER"])
+
+def list_files():
+    files = []
+    for path in backupFiles:
+        if os.path.isdir(path):
+            for root, dirs, names in os.walk(path):
+                dirs.sort()
+                files += [ os.path.join(root, name) for name in sorted(names) ]
+        elif os.path.isfile(path):
+            files.append(path)
+    return files
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# {file: sha256} of all backed up files that can be read, runs on the offload executor
+def hash_files():
+    hashes = {}
+    for file in list_files():
+        try:
+            hashes[file] = hash_file(file)
+        except OSError as error:
+            print(f"Error reading {file}: {error}")
+    return hashes
+
+def read_manifest():
+    try:
+        with open(manifestFile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_manifest(manifest):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(f"{manifestFile}.tmp", "w") as f:
+            json.dump(manifest, f)
+        os.replace(f"{manifestFile}.tmp", manifestFile)
+    except OSError as error:
+        print(f"Error writing backup manifest: {error}")
+
+class _CountingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.count += len(data)
+        return len(data)
 
-def delete_local_backup():
-    if os.path.exists(backupTempName):
-        os.remove(backupTempName)
+# runs in a thread, returns the number of bytes written or None if the pipe broke
+def _write_archive(fd, files, manifest):
+    try:
+        with os.fdopen(fd, "wb") as pipe:
+            writer = _CountingWriter(pipe)
+            with tarfile.open(fileobj=writer, mode="w|gz") as tar:
+                for file in files:
+                    tar.add(file, arcname=file.lstrip('/'), recursive=False)
+                data = json.dumps(manifest, indent=2).encode()
+                info = tarfile.TarInfo(manifestMember)
+                info.size = len(data)
+                info.mtime = int(time.time())
+                tar.addfile(info, io.BytesIO(data))
+        return writer.count
+    except OSError as error:
+        print(f"Error creating backup: {error}")
+        return None
+
+# the archive is written into a pipe that ssh reads from, so it never touches the local disk
+# returns the number of bytes uploaded or None on error
+async def stream_backup_to_remote(settings, remoteFileName, files, manifest):
+    program, env = ssh_program(settings, remote_write_command(remoteFileName))
+    read_fd, write_fd = os.pipe()
+    # the read end is closed once ssh holds it, so the writer fails instead of blocking if ssh dies
+    size, result = await asyncio.gather(asyncio.to_thread(_write_archive, write_fd, files, manifest),
+        process.run(program, env=env, stdin=read_fd, timeout=UPLOAD_TIMEOUT))
+    if not result.ok:
+        print(f"Error copying backup to remote: {result.error()}")
+        size = None
+    if size is None:
+        # do not leave a truncated archive behind, it would be taken as the latest backup
+        await run_remote(settings, f"rm -f {shlex.quote(remoteFileName)}")
+    return size
+
+# uploads only the files that changed since the last backup to the same target, the archive
+# contains a manifest that maps every backed up file to the archive holding its current content
+# returns a status text for home assistant
+async def incremental_backup():
+    settings = await get_settings()
+    if settings is None:
+        print("Backup not configured, nothing uploaded.")
+        return "not configured"
+    target = backup_target(settings)
+    previous = await offload.run("backup_files", read_manifest)
+    if previous.get("target") != target:
+        previous = {}
+    previous_files = previous.get("files", {})
+
+    files = {}
+    changed = []
+    for file, sha256 in (await offload.run("backup_files", hash_files)).items():
+        if previous_files.get(file, {}).get("sha256") == sha256:
+            files[file] = previous_files[file]
+        else:
+            files[file] = { "sha256": sha256 }
+            changed.append(file)
+
+    if not changed and files.keys() == previous_files.keys():
+        print("Backup unchanged, nothing uploaded.")
+        return "unchanged"
+
+    archive = time.strftime("%Y%m%d-%H%M%S") + ".tar.gz"
+    for file in changed:
+        files[file]["archive"] = archive
+    manifest = { "target": target, "archive": archive, "files": files }
+    size = await stream_backup_to_remote(settings, settings["BACKUP_SSH_FOLDER"] + "/" + archive, changed, manifest)
+    if size is None:
+        return "failed"
+    # the local manifest additionally remembers which archives each backup needs for a restore
+    history = previous.get("history", {})
+    history[archive] = sorted({ entry["archive"] for entry in files.values() })
+    await offload.run("backup_files", write_manifest, manifest | { "history": history })
+    print(f"Backup {archive} with {len(changed)} changed files uploaded, {size} bytes.")
+    return f"uploaded {size} bytes"
+
+async def run_remote(settings, remote_command, decode=True):
+    program, env = ssh_program(settings, remote_command)
+    result = await process.run(program, env=env, timeout=REMOTE_TIMEOUT)
+    if not result.ok:
+        print(f"Error running remote command: {result.error()}")
+        return None
+    return result.stdout.decode() if decode else result.stdout
+
+# keeps the newest archive of each of the last keep_daily days and keep_weekly weeks, plus all
+# archives these need for a restore, archives without a local history are self-contained
+def select_prunable(archives, history, keep_daily, keep_weekly):
+    days = {}
+    weeks = {}
+    for archive in sorted(archives, reverse=True):
+        day = _ARCHIVE_NAME.match(archive).group(1)
+        week = datetime.date(int(day[:4]), int(day[4:6]), int(day[6:])).isocalendar()[:2]
+        days.setdefault(day, archive)
+        weeks.setdefault(week, archive)
+    keep = set(list(days.values())[:keep_daily]) | set(list(weeks.values())[:keep_weekly])
+    for archive in list(keep):
+        keep.update(history.get(archive, []))
+    return sorted(archive for archive in archives if archive not in keep)
+
+async def prune_remote(keep_daily, keep_weekly):
+    settings = await get_settings()
+    manifest = await offload.run("backup_files", read_manifest)
+    if settings is None or manifest.get("target") != backup_target(settings):
+        # without knowing which archives the latest backup needs nothing is deleted
+        return 0
+    folder = settings["BACKUP_SSH_FOLDER"]
+    listing = await run_remote(settings, f"ls -1 {shlex.quote(folder)}")
+    if listing is None:
+        return 0
+    archives = [ name for name in listing.split() if _ARCHIVE_NAME.match(name) ]
+    history = manifest.get("history", {})
+    prunable = select_prunable(archives, history, keep_daily, keep_weekly)
+    # the latest backup is always kept, whatever the retention says
+    prunable = [ archive for archive in prunable
+        if archive != manifest["archive"] and archive not in history.get(manifest["archive"], []) ]
+    if not prunable:
+        return 0
+    files = " ".join(shlex.quote(f"{folder}/{archive}") for archive in prunable)
+    if await run_remote(settings, f"rm -f {files}") is None:
+        return 0
+    for archive in prunable:
+        history.pop(archive, None)
+    await offload.run("backup_files", write_manifest, manifest | { "history": history })
+    print(f"Pruned {len(prunable)} remote backups.")
+    return len(prunable)
+
+def is_backup_path(path):
+    return any(path == file or path.startswith(file + "/") for file in backupFiles)
+
+# returns the manifest (None for archives made before manifests existed) and the backed up files
+def read_archive(data):
+    manifest = None
+    files = {}
+    with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+        for member in tar:
+            if member.name == manifestMember:
+                manifest = json.load(tar.extractfile(member))
+                continue
+            if not member.isfile():
+                continue
+            path = "/" + member.name
+            # never write anything outside of the backed up files
+            if ".." in path.split("/") or not is_backup_path(path):
+                raise ValueError(f"unexpected file {member.name} in backup")
+            files[path] = tar.extractfile(member).read()
+    return manifest, files
+
+async def latest_remote_archive(settings):
+    listing = await run_remote(settings, f"ls -1 {shlex.quote(settings['BACKUP_SSH_FOLDER'])}")
+    archives = sorted(name for name in (listing or "").split() if _ARCHIVE_NAME.match(name))
+    if not archives:
+        raise ValueError("no remote backup found")
+    return archives[-1]
+
+# archive is a local file, a remote archive name or None for the latest remote archive, archives
+# referenced by its manifest are read from the same place, returns the archive name and files
+def read_file(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+async def load_backup(archive=None):
+    if archive is not None and os.path.isfile(archive):
+        folder, archive = os.path.split(archive)
+        async def fetch(name):
+            return await offload.run("backup_files", read_file, os.path.join(folder, name))
     else:
-        print("backup file does not exist")
+        settings = await get_settings()
+        if settings is None:
+            raise ValueError("backup not configured")
+        if archive is None:
+            archive = await latest_remote_archive(settings)
+        folder = settings["BACKUP_SSH_FOLDER"]
+        async def fetch(name):
+            data = await run_remote(settings, f"cat {shlex.quote(f'{folder}/{name}')}", decode=False)
+            if not data:
+                raise ValueError(f"backup {name} could not be read")
+            return data
+
+    # gunzip and tar parsing run on the offload executor, as all file IO of a restore
+    manifest, files = await offload.run("backup_files", read_archive, await fetch(archive))
+    if manifest is None:
+        # full backup without manifest
+        validate(files)
+        return archive, files
+
+    archives = { archive: files }
+    restored = {}
+    for path, entry in manifest["files"].items():
+        if entry["archive"] not in archives:
+            archives[entry["archive"]] = (await offload.run("backup_files", read_archive, await fetch(entry["archive"])))[1]
+        data = archives[entry["archive"]].get(path)
+        if data is None or hashlib.sha256(data).hexdigest() != entry["sha256"]:
+            raise ValueError(f"{path} in {entry['archive']} is missing or corrupt")
+        restored[path] = data
+    validate(restored)
+    return archive, restored
+
+def validate(files):
+    if envFile not in files:
+        raise ValueError("backup does not contain the env file")
+    if not dotenv_values(stream=io.StringIO(files[envFile].decode())):
+        raise ValueError("env file in backup is empty or invalid")
+
+def write_files(files):
+    # write to a temporary file next to the target and rename, so a file is either old or new
+    for path, data in files.items():
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".restore-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            if os.path.exists(path):
+                shutil.copymode(path, tmp)
+            else:
+                os.chmod(tmp, 0o644)
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
 
 async def main():
     print('backup test')
 
-    await create_local_backup()
-    await copy_backup_to_remote()
-    delete_local_backup()
+    print(await incremental_backup())
+    print(await prune_remote(7, 4))
 
 if __name__ == '__main__':
     asyncio.run(main())
\ No newline at end of file
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+
+# offline micro benchmarks for the pure CPU paths, no hardware, docker or network needed
+#
+#   python3 benchmarks/bench.py                 run and print ops/s and allocations
+#   python3 benchmarks/bench.py --save          store the results as baseline
+#   python3 benchmarks/bench.py --compare       compare against the baseline, exit 1 on regressions
+#
+# ops/s depend on the machine, so the baseline is not committed but saved locally, e.g. on the
+# commit to compare against before switching to the change
+
+import argparse
+import importlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+benchDir = os.path.dirname(os.path.abspath(__file__))
+fixtureDir = f"{benchDir}/fixtures"
+baselineFile = f"{benchDir}/baseline.json"
+
+sys.path.insert(0, os.path.dirname(benchDir))
+
+import alsa
+import compose
+import config
+import supervisor
+
+MIN_TIME = 0.2 # seconds per measurement
+REPEAT = 5
+
+def fixture(name):
+    with open(f"{fixtureDir}/{name}") as f:
+        return f.read()
+
+# name -> function without arguments, fixtures are loaded up front
+def benchmarks(tmp_dir):
+    eq_output = fixture("amixer_eq_scontents.txt")
+    volume_output = fixture("amixer_speaker_get.txt")
+    docker_output = fixture("docker_ps.txt")
+
+    node_id = config.node_id
+    topics = [
+        f"homeassistant/number/{node_id}/{node_id}_ch03_volume/set",
+        f"homeassistant/number/{node_id}/{node_id}_ch01_eq04_eqsetting/set",
+        f"homeassistant/button/{node_id}/{node_id}_ch02_eqpreset/set",
+        f"homeassistant/text/{node_id}/{node_id}_lms_host/set",
+        f"homeassistant/button/{node_id}/{node_id}_restart/do",
+    ]
+    def parse_topics():
+        for topic in topics:
+            supervisor.parse_topic(topic)
+
+    def build_entities():
+        importlib.reload(config)
+
+    def serialize_entities():
+        for entity in config.entities:
+            json.dumps(entity)
+
+    env_file = f"{tmp_dir}/.env"
+    shutil.copy(f"{fixtureDir}/compose.env", env_file)
+    compose.envFile = env_file
+    def read_config_value():
+        compose.read_config_value("GPIO_CH8_SPS")
+
+    values = iter(range(sys.maxsize))
+    def update_config_value():
+        compose.update_config_value("PSU_POWER_DOWN_DELAY", str(next(values) % 10))
+
+    return {
+        "alsa.extract_equalizer_settings": lambda: alsa.extract_equalizer_settings(eq_output),
+        "alsa.extract_volume_settings": lambda: alsa.extract_volume_settings(volume_output),
+        "compose.extract_container_status": lambda: compose.extract_container_status(docker_output),
+        "supervisor.parse_topic": parse_topics,
+        "config.entities": build_entities,
+        "config.entities.json": serialize_entities,
+        "compose.read_config_value": read_config_value,
+        "compose.update_config_value": update_config_value,
+    }
+
+def measure(fn):
+    # calibrate the number of calls to take at least MIN_TIME, then keep the best of REPEAT runs
+    loops = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        elapsed = time.perf_counter() - start
+        if elapsed >= MIN_TIME:
+            break
+        loops *= 2 if elapsed == 0 else max(2, int(MIN_TIME / elapsed * 1.2))
+    best = elapsed
+    for _ in range(REPEAT - 1):
+        start = time.perf_counter()
+        for _ in range(loops):
+            fn()
+        best = min(best, time.perf_counter() - start)
+
+    # peak of the memory allocated during a single call
+    tracemalloc.start()
+    fn()
+    tracemalloc.reset_peak()
+    current = tracemalloc.get_traced_memory()[0]
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    return { "ops": round(loops / best, 1), "alloc_bytes": peak - current }
+
+def compare(results, baseline, threshold):
+    regressions = []
+    print(f"{'benchmark':36} {'ops/s':>12} {'baseline':>12} {'change':>8} {'alloc B':>9} {'baseline':>9}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:36} {result['ops']:12.1f} {'-':>12} {'new':>8} {result['alloc_bytes']:9d} {'-':>9}")
+            continue
+        change = result["ops"] / base["ops"] - 1
+        print(f"{name:36} {result['ops']:12.1f} {base['ops']:12.1f} {change:+8.1%} "
+            f"{result['alloc_bytes']:9d} {base['alloc_bytes']:9d}")
+        if change < -threshold:
+            regressions.append(name)
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="offline micro benchmarks")
+    parser.add_argument("--save", action="store_true", help="store the results as baseline")
+    parser.add_argument("--compare", action="store_true", help="compare against the stored baseline")
+    parser.add_argument("--threshold", type=float, default=0.2, help="allowed slowdown, default 0.2 (20%%)")
+    parser.add_argument("--filter", default="", help="only run benchmarks containing this text")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = {}
+        for name, fn in benchmarks(tmp_dir).items():
+            if args.filter in name:
+                results[name] = measure(fn)
+                if not args.compare:
+                    print(f"{name:36} {results[name]['ops']:12.1f} ops/s {results[name]['alloc_bytes']:9d} B")
+
+    if args.compare:
+        try:
+            with open(baselineFile) as f:
+                baseline = json.load(f)
+        except FileNotFoundError:
+            print(f"No baseline in {baselineFile}, run with --save on the commit to compare against first.")
+            sys.exit(2)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"Slower than baseline: {', '.join(regressions)}")
+            sys.exit(1)
+
+    if args.save:
+        with open(baselineFile, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {baselineFile}")
+
+if __name__ == '__main__':
+    main()
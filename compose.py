@@ -4,25 +4,38 @@ import aiohttp
 import asyncio
 import json
 import os
+import re
 import tempfile
-from dotenv.main import get_key, set_key
+from dotenv.main import dotenv_values, get_key, set_key
 
-from dbus_fast import BusType
-from dbus_fast.aio import MessageBus
+import docker_engine
+import process
+import systembus
 
 envFile = "/etc/opt/compose/.env"
 
-async def run_subprocess(program):
-    p = await asyncio.create_subprocess_exec(*program,
-        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-    stdout, stderr = await p.communicate()
-    if p.returncode != 0:
-        print(f"Error running {program[0]}: {stderr.decode()}")
+UP_TIMEOUT = 5*60 # seconds, recreating containers may include an image pull
+PULL_TIMEOUT = 30*60 # seconds
+
+# default compose file names in lookup order if COMPOSE_FILE is not set
+composeFileNames = [ 'compose.yaml', 'compose.yml', 'docker-compose.yml', 'docker-compose.yaml' ]
+
+_model = None
+_model_lock = asyncio.Lock()
+
+async def run_subprocess(program, timeout=process.DEFAULT_TIMEOUT):
+    result = await process.run(program, timeout=timeout)
+    if not result.ok:
+        print(f"Error: {result.error()}")
         return None
-    return stdout.decode()
+    return result.stdout.decode()
 
 # created, restarting, running, removing, paused, exited and dead
 async def get_container_status():
+    try:
+        return await docker_engine.get_container_status()
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
     program = [ 'docker', 'ps', '--format', '{{.Names}}:{{.State}}' ]
     stdout = await run_subprocess(program)
     if stdout is not None:
@@ -37,154 +50,208 @@ def extract_container_status(result):
             status[line[0]] = line[1]
     return status
 
-async def up(profile, recreate=False, service=None):
+async def up(profile, recreate=False, *services):
     program = [ 'docker', 'compose', '--env-file', envFile, '--profile', profile, 'up', '--detach' ]
     if recreate:
         program.append('--force-recreate')
-    if service:
-        program.append(service)
-    stdout = await run_subprocess(program)
+    program += services
+    stdout = await run_subprocess(program, UP_TIMEOUT)
     if stdout is not None:
         print(stdout)
 
-async def docker_platform():
-    program = [ 'uname', '-m' ]
-    stdout = await run_subprocess(program)
-    if stdout is not None:
-        platform = stdout.strip()
-        if platform == "armv7l":
-            return {
-                "architecture": "arm",
-                "os": "linux",
-                "variant": "v7"
-            }
-        elif platform == "aarch64":
-            return {
-                "architecture": "arm64",
-                "os": "linux"
-            }
+async def wait_running(container, timeout, interval=0.5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        try:
+            result = await docker_engine.container_inspect(container)
+        except (aiohttp.ClientError, OSError):
+            result = await get_container_status()
+            if result is not None and result.get(container) == "running":
+                return True
+        else:
+            if result is not None and result["State"]["Status"] == "running":
+                return True
+        await asyncio.sleep(interval)
+    return False
+
+def compose_files():
+    compose_file = os.environ.get("COMPOSE_FILE") or dotenv_values(envFile).get("COMPOSE_FILE")
+    if compose_file:
+        return compose_file.split(os.environ.get("COMPOSE_PATH_SEPARATOR", os.pathsep))
+    # compose looks up the file in the working dir and its parents
+    path = os.getcwd()
+    while True:
+        for name in composeFileNames:
+            if os.path.exists(os.path.join(path, name)):
+                return [os.path.join(path, name)]
+        if os.path.dirname(path) == path:
+            return []
+        path = os.path.dirname(path)
+
+def files_state(files):
+    state = {}
+    for file in files:
+        try:
+            stat = os.stat(file)
+            state[file] = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            state[file] = None
+    return state
+
+# "*" in env means the service may read any key, e.g. through env_file
+def service_env(service, raw_service):
+    # env references are taken from the not interpolated config
+    env = set(re.findall(r"\$\{?([A-Za-z_][A-Za-z0-9_]*)", json.dumps(raw_service)))
+    # variables named directly, compose config also merges env_file contents into environment
+    for config in (service, raw_service):
+        environment = config.get("environment") or {}
+        if isinstance(environment, list):
+            environment = dict(item.partition("=")[::2] for item in environment)
+        env.update(environment.keys())
+        if config.get("env_file"):
+            env.add("*")
+    return env
+
+def index_model(project, raw_project):
+    services = {}
+    for name, service in project.get("services", {}).items():
+        services[name] = {
+            "image": service.get("image"),
+            "build": service.get("build"),
+            "profiles": service.get("profiles", []),
+            "env": service_env(service, raw_project.get("services", {}).get(name, {})),
+        }
+    return services
+
+# parsed `docker compose config` of all profiles, rebuilt when the env or compose files change
+async def get_model():
+    global _model
+    async with _model_lock:
+        if _model is not None and _model["state"] == files_state(_model["files"]):
+            return _model["services"]
+
+        # the env file is part of the watched files, so a changed COMPOSE_FILE is picked up as well,
+        # it is read in a thread like all env file reads
+        files = [envFile] + await asyncio.to_thread(compose_files)
+        state = files_state(files)
+
+        program = [ 'docker', 'compose', '--env-file', envFile, 'config', '--profiles' ]
+        stdout = await run_subprocess(program)
+        if stdout is None:
+            return None
+        program = [ 'docker', 'compose', '--env-file', envFile ]
+        for profile in stdout.split():
+            program += [ '--profile', profile ]
+        stdout = await run_subprocess(program + [ 'config', '--format', 'json' ])
+        raw_stdout = await run_subprocess(program + [ 'config', '--format', 'json', '--no-interpolate' ])
+        if stdout is None or raw_stdout is None:
+            return None
 
+        _model = {
+            "files": files,
+            "state": state,
+            "services": index_model(json.loads(stdout), json.loads(raw_stdout))
+        }
+        return _model["services"]
+
+async def get_service(service):
+    services = await get_model()
+    if services is not None:
+        if service in services:
+            return services[service]
+        print(f"Error: compose service {service} does not exist")
     return None
- 
-async def is_local_build(service):
-    program = [ 'docker', 'compose', '--env-file', envFile, 'config', '--format', 'json', service ] 
-    stdout = await run_subprocess(program)
-    if stdout is not None:
-        result = json.loads(stdout)
-        if "build" in result["services"][service]:
-            return True
 
-        return False
+async def is_local_build(service):
+    config = await get_service(service)
+    if config is not None:
+        return config["build"] is not None
 
 async def image_from_compose_service(service):
-    program = [ 'docker', 'compose', '--env-file', envFile, 'config', '--images', service ]
-    stdout = await run_subprocess(program)
-    if stdout is not None:
-        return stdout.strip()
+    config = await get_service(service)
+    if config is not None:
+        return config["image"]
+
+async def services_of_profile(profile):
+    services = await get_model()
+    if services is not None:
+        return [name for name, config in services.items() if profile in config["profiles"]]
+
+# services that need to be recreated if the env file key changes
+async def services_using_config_value(key):
+    services = await get_model()
+    if services is not None:
+        return [name for name, config in services.items() if key in config["env"] or "*" in config["env"]]
 
 async def image_digest_local(image):
+    try:
+        result = await docker_engine.image_inspect(image)
+        if result is not None:
+            return result["Id"]
+        return ""
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
     program = [ 'docker', 'images', '-q', '--no-trunc', image ]
     stdout = await run_subprocess(program)
     if stdout is not None:
         return stdout.strip()
 
-async def image_registry_auth(session, image):
-    registry = "ghcr.io"
-    org = "library"
-    tag = "latest"
-    if ":" in image:
-        repo, tag = image.split(":")
-    else:
-        repo = image
-    if "/" in repo:
-        parts = repo.split("/")
-        if len(parts) == 3:
-            registry = parts[0]
-            org = parts[1]
-            repo = parts[2]
-        else:
-            org = parts[0]
-            repo = parts[1]
-
-    base_url = f"https://{registry}/v2/{org}/{repo}"
-    token = None
-
-    url = "https://ghcr.io/token"
-    params = {
-        "service": "ghcr.io",
-        "scope": f"repository:{org}/{repo}:pull",
-        "client_id": "shell"
-    }
-    async with session.get(url, params=params) as response:
-        data = await response.json()
-        token = data["token"]
-
-    return base_url, tag, token
-
-async def image_digest_remote(session, base_url, token, tag):
-    url = f"{base_url}/manifests/{tag}"
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.docker.distribution.manifest.v2+json,application/vnd.oci.image.index.v1+json"
-    }
-    async with session.get(url, headers=headers) as response:
-        data = await response.json()
-
-        if "errors" in data:
-            return None
-
-        platform = await docker_platform()
-        for manifest in data['manifests']:
-            if manifest["platform"] == platform:
-                return manifest["digest"]
-
-    return None
+# registry digests (sha256:...) the local image was pulled by, empty if it was never pulled
+async def image_repo_digests(image):
+    try:
+        result = await docker_engine.image_inspect(image)
+        if result is None:
+            return []
+        return [digest.rpartition("@")[2] for digest in result.get("RepoDigests") or []]
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
+    program = [ 'docker', 'image', 'inspect', '--format', '{{join .RepoDigests " "}}', image ]
+    stdout = await run_subprocess(program)
+    if stdout is not None:
+        return [digest.rpartition("@")[2] for digest in stdout.split()]
+    return []
+
+# image id the container was created from, differs from image_digest_local after a pull until the container is recreated
+async def container_image_digest(container):
+    try:
+        result = await docker_engine.container_inspect(container)
+        if result is not None:
+            return result["Image"]
+        return None
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
+    program = [ 'docker', 'inspect', '--format', '{{.Image}}', container ]
+    stdout = await run_subprocess(program)
+    if stdout is not None:
+        return stdout.strip()
 
-async def get_image_versions(session, base_url, token, local_digest, remote_digest):
-    url = f"{base_url}/tags/list"
-    headers = {
-        "Authorization": f"Bearer {token}"
-    }
-    versions = []
-    async with session.get(url, headers=headers) as response:
-        data = await response.json()
-        for tag in data["tags"]:
-            if tag == "latest" or tag == "main":
-                continue
-            else:
-                versions.append(tag[1:])
-
-        # https://stackoverflow.com/a/2574090
-        versions.sort(key=lambda s: [int(u) for u in s.split('.')], reverse=True)
-
-    local_version = None
-    remote_version = None
-    for version in versions:
-        tag = f"v{version}"
-        digest = await image_digest_remote(session, base_url, token, tag)
-        if digest == local_digest:
-            local_version = version
-        if digest == remote_digest:
-            remote_version = version
-        if local_version is not None and remote_version is not None:
-            break
-
-    return local_version, remote_version
-
-async def image_pull(name):
+async def image_pull(name, progress=None):
+    try:
+        return await docker_engine.image_pull(name, progress)
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
     program = [ 'docker', 'pull', name ]
-    stdout = await run_subprocess(program)
+    stdout = await run_subprocess(program, PULL_TIMEOUT)
     if stdout is not None:
         print(stdout)
+        return True
+    return False
 
 async def image_prune():
+    try:
+        count, reclaimed = await docker_engine.image_prune()
+        print(f"Deleted {count} images, total reclaimed space: {reclaimed} bytes")
+        return reclaimed
+    except (aiohttp.ClientError, OSError) as error:
+        print(f"Docker engine request failed ({error}), falling back to docker cli")
     program = [ 'docker', 'image', 'prune', '-f' ]
     stdout = await run_subprocess(program)
     if stdout is not None:
         print(stdout)
 
 async def start_update_service(service_name):
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+    bus = await systembus.get_bus()
     introspection = await bus.introspect(
         'org.freedesktop.systemd1',
         '/org/freedesktop/systemd1'
@@ -196,7 +263,6 @@ async def start_update_service(service_name):
     )
     manager = proxy.get_interface('org.freedesktop.systemd1.Manager')
     await manager.call_start_unit(service_name, 'replace')
-    bus.disconnect()
 
 def read_config_value(key):
     value = get_key(envFile, key)
@@ -218,9 +284,8 @@ def update_config_value(key, value):
 async def main():
     print('compose test')
 
-    print(await docker_platform())
-
-    session = aiohttp.ClientSession()
+    print(await services_of_profile("on"))
+    print(await services_using_config_value("LMS_HOST"))
 
     services = ["supervisor", "squeezelite_tpl"]
     for service in services:
@@ -228,32 +293,11 @@ async def main():
         if not is_local:
             image = await image_from_compose_service(service)
             local_digest = await image_digest_local(image)
-            base_url, tag, token = await image_registry_auth(session, image)
-            remote_digest = await image_digest_remote(session, base_url, token, tag)
             print(f"{service}: {image}")
             print(f"Local: {local_digest}")
-            print(f"Remote: {remote_digest}")
-            if "latest" in image:
-                versions = await get_image_versions(session, base_url, token, local_digest, remote_digest)
-                print(versions)
         else:
             print("local image")
 
-    image = "ghcr.io/aschamberger/sma-squeezelite"
-    base_url, tag, token = await image_registry_auth(session, image)
-    remote_digest = await image_digest_remote(session, base_url, token, tag)
-    print(remote_digest)
-    local_digest = remote_digest
-
-    versions = await get_image_versions(session, base_url, token, local_digest, remote_digest)
-    print(versions)
-
-    image = "ghcr.io/aschamberger/sma-squeezelite:main"
-    base_url, tag, token = await image_registry_auth(session, image)
-    print(await image_digest_remote(session, base_url, token, tag))
-
-    await session.close()
-
     #print(await get_container_status())
     #await up('on')
 
@@ -31,6 +31,9 @@ eq_presets = {
 discovery_prefix = "homeassistant"
 node_id = f"sma{''.join(re.findall('..', '%012x' % uuid.getnode()))}"
 
+# persistent cache for data that can be rebuilt, e.g. registry digests
+cache_dir = "/etc/opt/compose/.cache"
+
 subscriptions = [
     f"{discovery_prefix}/+/{node_id}/+/do",
     f"{discovery_prefix}/+/{node_id}/+/set"
@@ -156,6 +159,26 @@ entities = [
         "icon": "mdi:cloud-upload",
         "cmd_t": "~/do"
     },
+    {
+        "~": f"{discovery_prefix}/button/{node_id}/{node_id}_restore_backup",
+        "unique_id": f"{node_id}_restore_backup",
+        "name": "Restore Latest Backup",
+        "object_id": f"{node_id}_restore_backup",
+        "device": device,
+        "entity_category": "config",
+        "icon": "mdi:cloud-download",
+        "cmd_t": "~/do"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_backup_status",
+        "unique_id": f"{node_id}_backup_status",
+        "name": "Remote Backup Status",
+        "object_id": f"{node_id}_backup_status",
+        "device": device,
+        "entity_category": "diagnostic",
+        "icon": "mdi:cloud-check",
+        "stat_t": "~/state"
+    },
     {
         "~": f"{discovery_prefix}/text/{node_id}/{node_id}_backup_host",
         "unique_id": f"{node_id}_backup_host",
@@ -239,6 +262,87 @@ entities = [
         "cmd_t": "~/set",
         "stat_t": "~/state"
     },
+    {
+        "~": f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_gpio_mute_button",
+        "unique_id": f"{node_id}_gpio_mute_button",
+        "name": "Mute Button",
+        "object_id": f"{node_id}_gpio_mute_button",
+        "device": device,
+        "entity_category": "diagnostic",
+        "icon": "mdi:gesture-tap-button",
+        "stat_t": "~/state"
+    },
+    {
+        "~": f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_gpio_psu_fault",
+        "unique_id": f"{node_id}_gpio_psu_fault",
+        "name": "Power Supply Fault",
+        "object_id": f"{node_id}_gpio_psu_fault",
+        "device": device,
+        "entity_category": "diagnostic",
+        "dev_cla": "problem",
+        "stat_t": "~/state"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_usb_recoveries",
+        "unique_id": f"{node_id}_usb_recoveries",
+        "name": "USB DAC Recoveries",
+        "object_id": f"{node_id}_usb_recoveries",
+        "device": device,
+        "entity_category": "diagnostic",
+        "icon": "mdi:usb",
+        "stat_cla": "total_increasing",
+        "stat_t": "~/state"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_usb_outage",
+        "unique_id": f"{node_id}_usb_outage",
+        "name": "USB DAC Last Outage",
+        "object_id": f"{node_id}_usb_outage",
+        "device": device,
+        "entity_category": "diagnostic",
+        "dev_cla": "duration",
+        "unit_of_meas": "s",
+        "stat_t": "~/state",
+        "json_attr_t": "~/attributes"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_latency_p50",
+        "unique_id": f"{node_id}_latency_p50",
+        "name": "Command Latency P50",
+        "object_id": f"{node_id}_latency_p50",
+        "device": device,
+        "entity_category": "diagnostic",
+        "en": False,
+        "icon": "mdi:timer-outline",
+        "unit_of_meas": "ms",
+        "stat_t": "~/state",
+        "json_attr_t": "~/attributes"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_latency_p99",
+        "unique_id": f"{node_id}_latency_p99",
+        "name": "Command Latency P99",
+        "object_id": f"{node_id}_latency_p99",
+        "device": device,
+        "entity_category": "diagnostic",
+        "en": False,
+        "icon": "mdi:timer-outline",
+        "unit_of_meas": "ms",
+        "stat_t": "~/state",
+        "json_attr_t": "~/attributes"
+    },
+    {
+        "~": f"{discovery_prefix}/sensor/{node_id}/{node_id}_loop_lag",
+        "unique_id": f"{node_id}_loop_lag",
+        "name": "Max Event Loop Lag",
+        "object_id": f"{node_id}_loop_lag",
+        "device": device,
+        "entity_category": "diagnostic",
+        "icon": "mdi:timer-alert-outline",
+        "unit_of_meas": "ms",
+        "stat_cla": "measurement",
+        "stat_t": "~/state"
+    },
     {
         "~": f"{discovery_prefix}/update/{node_id}/{node_id}_update_supervisor",
         "unique_id": f"{node_id}_update_supervisor",
@@ -283,6 +387,16 @@ for channel in range(1, num_channels+1):
             "dev_cla": "running",
             "stat_t": "~/state"
         },
+        {
+            "~": f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_ch{channel}_hermes",
+            "unique_id": f"{node_id}_ch{channel}_hermes",
+            "name": f"Hermes Container State",
+            "object_id": f"{node_id}_ch{channel}_hermes",
+            "device": subdevice,
+            "entity_category": "diagnostic",
+            "dev_cla": "running",
+            "stat_t": "~/state"
+        },
         {
             "~": f"{discovery_prefix}/text/{node_id}/{node_id}_ch{channel}_player_name",
             "unique_id": f"{node_id}_ch{channel}_player_name",
@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+
+# LMS discovery via UDP broadcast and MQTT broker discovery via zeroconf, both run
+# concurrently on the event loop and return on the first valid answer
+
+from pysqueezebox.discovery import (
+    DISCOVERY_MESSAGE,
+    BROADCAST_ADDR,
+    _unpack_discovery_response,
+)
+from zeroconf import IPVersion, ServiceStateChange
+from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo, AsyncZeroconf
+
+import asyncio
+import socket
+
+DISCOVERY_TIMEOUT = 5 # seconds
+
+MQTT_SERVICE_TYPE = "_mqtt._tcp.local."
+
+class LmsDiscoveryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, result):
+        self.result = result
+
+    def connection_made(self, transport):
+        print("Sending LMS discovery message.")
+        transport.sendto(DISCOVERY_MESSAGE, BROADCAST_ADDR)
+
+    def datagram_received(self, data, addr):
+        print(f"Received LMS discovery response from {addr}")
+        response = _unpack_discovery_response(data, addr)
+        if response:
+            if "host" not in response or "json" not in response:
+                print(f"LMS discovery response {response} does not contain enough information to connect")
+            elif not self.result.done():
+                self.result.set_result(f"{response['host']}:{response['json']}")
+
+    def error_received(self, exc):
+        print(f"LMS discovery error: {exc}")
+
+async def discover_lms(timeout=DISCOVERY_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+    transport, _ = await loop.create_datagram_endpoint(
+        lambda: LmsDiscoveryProtocol(result), sock=sock)
+
+    try:
+        return await asyncio.wait_for(result, timeout)
+    except asyncio.TimeoutError:
+        print("No LMS discovered.")
+        return None
+    finally:
+        transport.close()
+
+async def discover_mqtt(timeout=DISCOVERY_TIMEOUT):
+    loop = asyncio.get_running_loop()
+    result = loop.create_future()
+    aiozc = AsyncZeroconf()
+
+    async def resolve(name):
+        info = AsyncServiceInfo(MQTT_SERVICE_TYPE, name)
+        if await info.async_request(aiozc.zeroconf, 3000):
+            # callers split host and port at the colon, so only IPv4 addresses are usable
+            addresses = info.parsed_addresses(IPVersion.V4Only)
+            if addresses and not result.done():
+                result.set_result(f"{addresses[0]}:{info.port}")
+
+    resolvers = set()
+    def on_service_state_change(zeroconf, service_type, name, state_change):
+        if state_change is ServiceStateChange.Added:
+            task = asyncio.create_task(resolve(name))
+            resolvers.add(task)
+            task.add_done_callback(resolvers.discard)
+
+    browser = AsyncServiceBrowser(aiozc.zeroconf, MQTT_SERVICE_TYPE, handlers=[on_service_state_change])
+    try:
+        return await asyncio.wait_for(result, timeout)
+    except asyncio.TimeoutError:
+        print("No MQTT broker discovered.")
+        return None
+    finally:
+        for task in resolvers:
+            task.cancel()
+        await browser.async_cancel()
+        await aiozc.async_close()
+
+# returns {"lms": "host:port", "mqtt": "host:port"} for the requested services, None if not found
+async def discover(lms=True, mqtt=True):
+    discoverers = {}
+    if lms:
+        discoverers["lms"] = discover_lms
+    if mqtt:
+        discoverers["mqtt"] = discover_mqtt
+
+    # the caller writes found endpoints to the env file, so discovery is not run again once they are known
+    results = await asyncio.gather(*[discoverer() for discoverer in discoverers.values()])
+    return dict(zip(discoverers, results))
+
+async def main():
+    print('discovery test')
+
+    print(await discover())
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,155 @@
+#!/usr/bin/python3
+
+# Docker Engine API client via the unix socket
+# https://docs.docker.com/engine/api/latest/
+
+import aiohttp
+import asyncio
+import json
+import metrics
+import os
+from urllib.parse import quote
+
+# DOCKER_HOST=unix:///path/to/socket allows to run against a fake docker daemon
+dockerSocket = os.environ.get("DOCKER_HOST", "unix:///var/run/docker.sock").removeprefix("unix://")
+baseUrl = "http://docker"
+
+_session = None
+
+def get_session():
+    # one pooled connection to the docker daemon for all requests
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.UnixConnector(path=dockerSocket, limit=4)
+        _session = aiohttp.ClientSession(connector=connector,
+            trace_configs=[metrics.http_trace_config("docker")])
+    return _session
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+# created, restarting, running, removing, paused, exited and dead
+async def get_container_status():
+    params = { "all": "true" }
+    async with get_session().get(f"{baseUrl}/containers/json", params=params) as response:
+        response.raise_for_status()
+        containers = await response.json()
+    status = {}
+    for container in containers:
+        for name in container["Names"]:
+            status[name.lstrip("/")] = container["State"]
+    return status
+
+async def container_inspect(name):
+    async with get_session().get(f"{baseUrl}/containers/{quote(name, safe='')}/json") as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return await response.json()
+
+async def image_inspect(reference):
+    async with get_session().get(f"{baseUrl}/images/{quote(reference, safe='')}/json") as response:
+        if response.status == 404:
+            return None
+        response.raise_for_status()
+        return await response.json()
+
+def split_reference(reference):
+    # registry host may contain a port, so only a colon after the last slash separates the tag
+    if "@" in reference:
+        return reference, None
+    name, _, tag = reference.rpartition(":")
+    if not name or "/" in tag:
+        return reference, "latest"
+    return name, tag
+
+# progress is an optional coroutine function called with the download percentage
+async def image_pull(reference, progress=None):
+    image, tag = split_reference(reference)
+    params = { "fromImage": image }
+    if tag is not None:
+        params["tag"] = tag
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+    layers = {}
+    percentage = -1
+    async with get_session().post(f"{baseUrl}/images/create", params=params, timeout=timeout) as response:
+        response.raise_for_status()
+        # the daemon streams one json object per line, errors are reported in the stream as well
+        async for line in response.content:
+            if not line.strip():
+                continue
+            message = json.loads(line)
+            if "error" in message:
+                print(f"Error pulling {reference}: {message['error']}")
+                return False
+            layer = message.get("id")
+            status = message.get("status", "")
+            detail = message.get("progressDetail") or {}
+            if layer is None:
+                continue
+            if status == "Downloading" and detail.get("total"):
+                layers[layer] = (detail["current"], detail["total"])
+            elif status in ("Download complete", "Pull complete", "Already exists") and layer in layers:
+                layers[layer] = (layers[layer][1], layers[layer][1])
+            if progress is not None and layers:
+                current = sum(done for done, size in layers.values())
+                total = sum(size for done, size in layers.values())
+                # layer sizes are only known once their download starts, so only report progress forward
+                if int(100*current/total) > percentage:
+                    percentage = int(100*current/total)
+                    await progress(percentage)
+    return True
+
+# returns number of deleted images and reclaimed space in bytes
+async def image_prune():
+    async with get_session().post(f"{baseUrl}/images/prune") as response:
+        response.raise_for_status()
+        result = await response.json()
+    deleted = result.get("ImagesDeleted") or []
+    return len(deleted), result.get("SpaceReclaimed", 0)
+
+# container state after a container event, None if the event does not change the state
+_EVENT_STATES = {
+    "create": "created",
+    "start": "running",
+    "unpause": "running",
+    "pause": "paused",
+    "die": "exited",
+    "destroy": "removed",
+}
+
+async def container_events(since=None):
+    filters = {
+        "type": ["container"],
+        "event": list(_EVENT_STATES.keys())
+    }
+    params = { "filters": json.dumps(filters) }
+    if since is not None:
+        params["since"] = str(since)
+    # the events stream never ends, so there must be no read timeout
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=None)
+    async with get_session().get(f"{baseUrl}/events", params=params, timeout=timeout) as response:
+        response.raise_for_status()
+        async for line in response.content:
+            if line.strip():
+                event = json.loads(line)
+                name = event.get("Actor", {}).get("Attributes", {}).get("name")
+                state = _EVENT_STATES.get(event.get("Action"))
+                if name is not None and state is not None:
+                    yield name, state
+
+async def main():
+    print('docker engine test')
+
+    print(await get_container_status())
+    print(await image_inspect("alpine:latest"))
+    async for name, state in container_events():
+        print(f"{name}: {state}")
+
+    await close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -3,11 +3,11 @@
 #gdbus introspect --system --dest io.gpiod1 --object-path /io/gpiod1/chips/
 #gdbus introspect --system --dest io.gpiod1 --object-path /io/gpiod1/chips/gpiochip0/line7
 
-from dbus_fast import BusType, Message, MessageType, Variant
-from dbus_fast.aio import MessageBus
+from dbus_fast import Message, MessageType, Variant
 
 import asyncio
 import json
+import systembus
 
 _BOARD_MAP = {
     3: 2, 
@@ -38,60 +38,78 @@ _BOARD_MAP = {
     40: 21,
 }
 
-# direction: input|output|as-is
-async def init(board_number, direction="output", active_low=False, value=None):
-    gpio = _BOARD_MAP[board_number]
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+# board number -> (request path, line offset), dropped when io.gpiod1 signals a change of the line or request
+_lines = {}
+# board number -> queues of edge_events() subscribers
+_edge_queues = {}
+# board number -> init_lines() settings of every requested line, requested again after a reconnect
+_requested = {}
+# board number -> last value written to an output, outputs are requested again with it
+_output_values = {}
+_rearm_task = None
 
-    reply = await bus.call(
-        Message(destination='io.gpiod1',
-                path=f'/io/gpiod1/chips/gpiochip0/line{gpio}',
-                interface='org.freedesktop.DBus.Properties',
-                member='Get',
-                signature='ss',
-                body=['io.gpiod1.Line', 'Managed']))
+_MATCH_RULES = [
+    "type='signal',sender='io.gpiod1',interface='org.freedesktop.DBus.Properties',member='PropertiesChanged',arg0='io.gpiod1.Line'",
+    "type='signal',sender='io.gpiod1',interface='org.freedesktop.DBus.ObjectManager',member='InterfacesRemoved'",
+    "type='signal',sender='io.gpiod1',interface='io.gpiod1.Line',member='EdgeEvent'",
+]
 
-    if reply.message_type == MessageType.ERROR:
-        raise Exception(reply.body[0])
+def _on_signal(message):
+    if message.message_type != MessageType.SIGNAL:
+        return
+    if message.member == 'EdgeEvent' and message.interface == 'io.gpiod1.Line':
+        # event data (ittt): edge (1 rising, 0 falling), timestamp ns, global seqno, line seqno
+        edge, timestamp, global_seqno, line_seqno = message.body[0]
+        gpio = message.path.rsplit('/line', 1)[-1]
+        for board_number, queues in _edge_queues.items():
+            if str(_BOARD_MAP[board_number]) == gpio:
+                for queue in queues:
+                    queue.put_nowait((1 if edge == 1 else 0, timestamp))
+    elif message.member == 'PropertiesChanged' and message.body[0] == 'io.gpiod1.Line':
+        # line requested or released: /io/gpiod1/chips/gpiochip0/line{gpio}
+        gpio = message.path.rsplit('/line', 1)[-1]
+        for board_number in list(_lines):
+            if str(_BOARD_MAP[board_number]) == gpio:
+                del _lines[board_number]
+    elif message.member == 'InterfacesRemoved':
+        # request released: /io/gpiod1/requests/request{N}
+        for board_number, (request_path, offset) in list(_lines.items()):
+            if request_path == message.body[0]:
+                del _lines[board_number]
 
-    # if not yet initialized
-    if not reply.body[0].value:
-        # request line config: (a(aua{sv})ai)
-        # @see: https://git.kernel.org/pub/scm/libs/libgpiod/libgpiod.git/tree/dbus/client/common.c#n528
-        line_offsets = [gpio]
-        line_settings = {
-            "direction": Variant('s', direction),
-            "active-low": Variant('b', active_low),            
-        }
-        line_config = [line_offsets, line_settings]
-        line_configs = [line_config]
-        output_values = []
-        if not value == None:
-            output_values = [value]
-        request_line_config = [line_configs, output_values]
-        # request options: a{sv}
-        request_options = {
-            "consumer": Variant('s', "gpio-manager")
-        }
-        
-        reply = await bus.call(
-            Message(destination='io.gpiod1',
-                    path='/io/gpiod1/chips/gpiochip0',
-                    interface='io.gpiod1.Chip',
-                    member='RequestLines',
-                    signature='(a(aua{sv})ai)a{sv}',
-                    body=[request_line_config, request_options])) #TODO
-
-        if reply.message_type == MessageType.ERROR:
-            raise Exception(reply.body[0])
-
-        return reply.body[0]
+async def _on_connect(bus):
+    global _rearm_task
+    # signals might have been missed while disconnected
+    _lines.clear()
+    bus.add_message_handler(_on_signal)
+    for rule in _MATCH_RULES:
+        await bus.call(
+            Message(destination='org.freedesktop.DBus',
+                    path='/org/freedesktop/DBus',
+                    interface='org.freedesktop.DBus',
+                    member='AddMatch',
+                    signature='s',
+                    body=[rule]))
+    # runs once the connect is done, as the requests go through the bus that is connecting here,
+    # lines are only recorded once requested, so there is nothing to do on the first connect
+    if _requested:
+        _rearm_task = asyncio.create_task(_rearm_lines())
 
-async def get(board_number):
-    gpio = _BOARD_MAP[board_number]
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+async def _rearm_lines():
+    # gpio-manager releases the requests of a lost connection, outputs could not be set any more
+    # and inputs would not send edge events
+    for board_number, settings in list(_requested.items()):
+        values = [_output_values[board_number]] if board_number in _output_values else None
+        try:
+            await init_lines([board_number], values=values, **settings)
+        except Exception as error:
+            print(f"Error requesting GPIO {board_number} again: {error}")
+
+systembus.on_connect(_on_connect)
 
-    reply = await bus.call(
+async def _line_info(board_number):
+    gpio = _BOARD_MAP[board_number]
+    reply = await systembus.call(
         Message(destination='io.gpiod1',
                 path=f'/io/gpiod1/chips/gpiochip0/line{gpio}',
                 interface='org.freedesktop.DBus.Properties',
@@ -101,50 +119,155 @@ async def get(board_number):
 
     if reply.message_type == MessageType.ERROR:
         raise Exception(reply.body[0])
-   
+
     line_info = reply.body[0]
+    if line_info['Managed'].value:
+        _lines[board_number] = (line_info['RequestPath'].value, line_info['Offset'].value)
+    return line_info
 
-    reply = await bus.call(
-        Message(destination='io.gpiod1',
-                path=line_info['RequestPath'].value,
-                interface='io.gpiod1.Request',
-                member='GetValues',
-                signature='au',
-                body=[[line_info['Offset'].value]]))
+# group board numbers by their request: request path -> {board number: offset}
+async def _resolve(board_numbers):
+    requests = {}
+    for board_number in board_numbers:
+        if board_number not in _lines:
+            await _line_info(board_number)
+            if board_number not in _lines:
+                raise Exception(f"GPIO {board_number} is not requested")
+        request_path, offset = _lines[board_number]
+        requests.setdefault(request_path, {})[board_number] = offset
+    return requests
 
-    if reply.message_type == MessageType.ERROR:
-        raise Exception(reply.body[0])
-   
-    return reply.body[0][0]
+async def _call_requests(board_numbers, member, signature, body):
+    replies = {}
+    for attempt in range(2):
+        requests = await _resolve(board_numbers)
+        error = None
+        for request_path, offsets in requests.items():
+            reply = await systembus.call(
+                Message(destination='io.gpiod1',
+                        path=request_path,
+                        interface='io.gpiod1.Request',
+                        member=member,
+                        signature=signature,
+                        body=body(offsets)))
 
-async def set(board_number, value):
-    gpio = _BOARD_MAP[board_number]
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            if reply.message_type != MessageType.ERROR:
+                replies[request_path] = (offsets, reply)
+            else:
+                # cached request might be gone without a signal, resolve the lines again once
+                error = reply.body[0]
+                for board_number in offsets:
+                    _lines.pop(board_number, None)
+        if error is None:
+            return replies
+        board_numbers = [board_number for board_number in board_numbers if board_number not in _lines]
 
-    reply = await bus.call(
-        Message(destination='io.gpiod1',
-                path=f'/io/gpiod1/chips/gpiochip0/line{gpio}',
-                interface='org.freedesktop.DBus.Properties',
-                member='GetAll',
-                signature='s',
-                body=['io.gpiod1.Line']))
+    raise Exception(error)
 
-    if reply.message_type == MessageType.ERROR:
-        raise Exception(reply.body[0])
-   
-    line_info = reply.body[0]
+# request all lines with the same settings in one request
+# direction: input|output|as-is
+# edge: none|rising|falling|both, debounce_period in microseconds (only for inputs)
+# bias: as-is|disabled|pull-up|pull-down
+async def init_lines(board_numbers, direction="output", active_low=False, values=None,
+        edge=None, debounce_period=None, bias=None):
+    settings = {"direction": direction, "active_low": active_low, "edge": edge,
+        "debounce_period": debounce_period, "bias": bias}
+    all_board_numbers = board_numbers
+    # lines already managed by gpio-manager, e.g. after a supervisor restart, keep their request
+    board_numbers = [board_number for board_number in board_numbers
+        if not (await _line_info(board_number))['Managed'].value]
+    if not board_numbers:
+        _record(all_board_numbers, settings, values)
+        return None
 
-    reply = await bus.call(
+    # request line config: (a(aua{sv})ai)
+    # @see: https://git.kernel.org/pub/scm/libs/libgpiod/libgpiod.git/tree/dbus/client/common.c#n528
+    line_offsets = [_BOARD_MAP[board_number] for board_number in board_numbers]
+    line_settings = {
+        "direction": Variant('s', direction),
+        "active-low": Variant('b', active_low),
+    }
+    if edge is not None:
+        line_settings["edge"] = Variant('s', edge)
+    if debounce_period is not None:
+        line_settings["debounce-period"] = Variant('t', debounce_period)
+    if bias is not None:
+        line_settings["bias"] = Variant('s', bias)
+    line_config = [line_offsets, line_settings]
+    line_configs = [line_config]
+    output_values = []
+    if not values == None:
+        output_values = values
+    request_line_config = [line_configs, output_values]
+    # request options: a{sv}
+    request_options = {
+        "consumer": Variant('s', "gpio-manager")
+    }
+
+    reply = await systembus.call(
         Message(destination='io.gpiod1',
-                path=line_info['RequestPath'].value,
-                interface='io.gpiod1.Request',
-                member='SetValues',
-                signature='a{ui}',
-                body=[{line_info['Offset'].value: value}]))
+                path='/io/gpiod1/chips/gpiochip0',
+                interface='io.gpiod1.Chip',
+                member='RequestLines',
+                signature='(a(aua{sv})ai)a{sv}',
+                body=[request_line_config, request_options]))
 
     if reply.message_type == MessageType.ERROR:
         raise Exception(reply.body[0])
 
+    for board_number, gpio in zip(board_numbers, line_offsets):
+        _lines[board_number] = (reply.body[0], gpio)
+    _record(all_board_numbers, settings, values)
+    return reply.body[0]
+
+def _record(board_numbers, settings, values):
+    for index, board_number in enumerate(board_numbers):
+        _requested[board_number] = settings
+        if settings["direction"] == "output" and values is not None and index < len(values):
+            _output_values.setdefault(board_number, values[index])
+
+async def init(board_number, direction="output", active_low=False, value=None):
+    values = None
+    if not value == None:
+        values = [value]
+    return await init_lines([board_number], direction, active_low, values)
+
+# returns {board number: value}, with one GetValues call per request
+async def get_many(board_numbers):
+    replies = await _call_requests(board_numbers, 'GetValues', 'au',
+        lambda offsets: [list(offsets.values())])
+    values = {}
+    for offsets, reply in replies.values():
+        values.update(zip(offsets.keys(), reply.body[0]))
+    return values
+
+# values: {board number: value}, lines of the same request are set at once
+async def set_many(values):
+    await _call_requests(list(values.keys()), 'SetValues', 'a{ui}',
+        lambda offsets: [{offset: values[board_number] for board_number, offset in offsets.items()}])
+    for board_number, value in values.items():
+        if _requested.get(board_number, {}).get("direction") == "output":
+            _output_values[board_number] = value
+
+async def get(board_number):
+    values = await get_many([board_number])
+    return values[board_number]
+
+async def set(board_number, value):
+    await set_many({board_number: value})
+
+# async iterator of (value, timestamp ns) for each edge of an input requested with edge detection
+async def edge_events(board_number):
+    queue = asyncio.Queue()
+    _edge_queues.setdefault(board_number, []).append(queue)
+    # make sure the signal match is added
+    await systembus.get_bus()
+    try:
+        while True:
+            yield await queue.get()
+    finally:
+        _edge_queues[board_number].remove(queue)
+
 async def main():
     print('gpio test')
 
@@ -160,5 +283,16 @@ async def main():
     res = await get(26)
     print(res)
 
+    res = await init_lines([29, 31], "output", True)
+    print(res)
+    await set_many({29: 1, 31: 1})
+    print(await get_many([29, 31]))
+
+    await init_lines([37], "input", True, None, "both", 10000, "pull-up")
+    async for value, timestamp in edge_events(37):
+        print(f"{timestamp}: {value}")
+
+    await systembus.disconnect()
+
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    asyncio.run(main())
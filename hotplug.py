@@ -0,0 +1,88 @@
+#!/usr/bin/python3
+
+# usb hotplug events from the kernel uevent netlink socket
+# https://www.kernel.org/doc/html/latest/driver-api/usb/hotplug.html
+
+import asyncio
+import socket
+
+NETLINK_KOBJECT_UEVENT = 15
+UEVENT_GROUP_KERNEL = 1
+
+def parse_uevent(data):
+    # action@devpath\0KEY=VALUE\0KEY=VALUE...
+    parts = data.split(b'\0')
+    event = {}
+    for part in parts[1:]:
+        key, sep, value = part.decode(errors="replace").partition('=')
+        if sep:
+            event[key] = value
+    return event
+
+def usb_id_of_event(event):
+    # PRODUCT=d8c/102/100: vendor/product/bcdDevice in hex without leading zeros
+    if event.get("SUBSYSTEM") != "usb" or event.get("DEVTYPE") != "usb_device" or "PRODUCT" not in event:
+        return None
+    vendor, product = event["PRODUCT"].split('/')[:2]
+    return [int(vendor, 16), int(product, 16)]
+
+class UsbMonitor:
+    def __init__(self, usb_ids):
+        self.usb_ids = usb_ids
+        self.queue = asyncio.Queue()
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        self.sock.bind((0, UEVENT_GROUP_KERNEL))
+        self.sock.setblocking(False)
+        asyncio.get_running_loop().add_reader(self.sock.fileno(), self._read)
+
+    def _read(self):
+        while True:
+            try:
+                data = self.sock.recv(16384)
+            except BlockingIOError:
+                return
+            except OSError as error:
+                # e.g. ENOBUFS if events got lost, the consistency check catches up
+                print(f"Error reading uevent: {error}")
+                return
+            event = parse_uevent(data)
+            usb_id = usb_id_of_event(event)
+            if usb_id in self.usb_ids:
+                self.queue.put_nowait((event.get("ACTION"), usb_id))
+
+    def clear(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+
+    # waits for an event of one of the watched devices, returns False on timeout, without timeout it waits forever
+    async def wait_for(self, action, usb_id=None, timeout=None):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while True:
+            try:
+                remaining = deadline - loop.time() if deadline is not None else None
+                event_action, event_usb_id = await asyncio.wait_for(self.queue.get(), remaining)
+            except asyncio.TimeoutError:
+                return False
+            if event_action == action and usb_id in (None, event_usb_id):
+                return True
+
+    async def wait_removal(self, timeout):
+        return await self.wait_for("remove", timeout=timeout)
+
+    def close(self):
+        asyncio.get_running_loop().remove_reader(self.sock.fileno())
+        self.sock.close()
+
+async def main():
+    print('hotplug test')
+
+    usb_id_dacs = [0x0d8c, 0x0102]
+    usb_id_hub = [0x1a40, 0x0201]
+
+    monitor = UsbMonitor([usb_id_dacs, usb_id_hub])
+    while True:
+        print(await monitor.wait_removal(60))
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+# streams a backup of generated files through the fake ssh (loadtest/bin) into a local folder
+# and reports the throughput, FAKE_SSH_KBPS and FAKE_SSH_LATENCY_MS model the link
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup
+
+async def run(args):
+    with tempfile.TemporaryDirectory() as root:
+        files = []
+        for index in range(args.files):
+            path = f"{root}/files/file{index}"
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, "wb") as f:
+                # half random, so gzip has something to do but does not shrink everything away
+                f.write(os.urandom(args.size*512) + bytes(args.size*512))
+            files.append(path)
+        backup.envFile = f"{root}/.env"
+        with open(backup.envFile, "w") as f:
+            f.write(f"BACKUP_SSH_HOST=localhost\nBACKUP_SSH_PORT=22\nBACKUP_SSH_USER=backup\n"
+                f"BACKUP_SSH_PASSWORD=secret\nBACKUP_SSH_FOLDER={root}/remote\n")
+        os.makedirs(f"{root}/remote")
+        backup.controlPath = f"{root}/ssh-%C"
+
+        settings = await backup.get_settings()
+        start = time.monotonic()
+        size = await backup.stream_backup_to_remote(settings, f"{root}/remote/backup.tar.gz", files, {})
+        duration = time.monotonic() - start
+        if size is None:
+            sys.exit("Backup failed")
+        print(f"{len(files)} files, {size} bytes in {duration:.3f} seconds, {size/duration/1024:.0f} KiB/s")
+
+def main():
+    parser = argparse.ArgumentParser(description="backup streaming throughput against the fake ssh")
+    parser.add_argument("--files", type=int, default=20)
+    parser.add_argument("--size", type=int, default=256, help="KiB per file")
+    args = parser.parse_args()
+    os.environ["PATH"] = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bin") + os.pathsep + os.environ["PATH"]
+    asyncio.run(run(args))
+
+if __name__ == '__main__':
+    main()
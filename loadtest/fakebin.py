@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+
+# stand-in for amixer, alsactl, docker, ssh and sshpass, the program is picked by the name it is
+# called as (loadtest/bin has a symlink per program), ssh runs the remote command on this host
+#
+#   FAKE_STATE_DIR               mixer state and call log, shared by all calls
+#   FAKE_LATENCY_MS              delay of every call
+#   FAKE_<PROGRAM>_LATENCY_MS    delay of one program, e.g. FAKE_AMIXER_LATENCY_MS=50
+#   FAKE_SSH_KBPS                upload bandwidth of ssh in KiB/s, unlimited if unset
+
+import fcntl
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+
+stateDir = os.environ.get("FAKE_STATE_DIR", "/tmp")
+stateFile = f"{stateDir}/alsa.json"
+callLog = f"{stateDir}/calls.log"
+
+NUM_CHANNELS = 8
+EQ_CHANNELS = ["00. 31 Hz", "01. 63 Hz", "02. 125 Hz", "03. 250 Hz", "04. 500 Hz",
+    "05. 1 kHz", "06. 2 kHz", "07. 4 kHz", "08. 8 kHz", "09. 16 kHz"]
+SPEAKER_CHANNELS = ["Front Left", "Front Right", "Rear Left", "Rear Right",
+    "Front Center", "Woofer", "Side Left", "Side Right"]
+SPEAKER_MAX = 197
+
+def log_call(program, args):
+    # one write per line, so lines of concurrent calls do not interleave
+    line = f"{time.time():.6f} {program} {' '.join(args)}\n"
+    fd = os.open(callLog, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line.encode())
+    finally:
+        os.close(fd)
+
+def latency(program):
+    value = os.environ.get(f"FAKE_{program.upper()}_LATENCY_MS", os.environ.get("FAKE_LATENCY_MS", "0"))
+    time.sleep(int(value)/1000)
+
+# mixer state, read and written under an exclusive lock: {device: [percent, ...]}
+class MixerState:
+    def __enter__(self):
+        self.fd = os.open(stateFile, os.O_RDWR | os.O_CREAT, 0o644)
+        fcntl.flock(self.fd, fcntl.LOCK_EX)
+        data = os.read(self.fd, 1 << 20)
+        self.devices = json.loads(data) if data else {}
+        return self
+
+    def get(self, device, count, default):
+        return self.devices.setdefault(device, [default]*count)
+
+    def __exit__(self, *exc):
+        data = json.dumps(self.devices).encode()
+        os.lseek(self.fd, 0, os.SEEK_SET)
+        os.ftruncate(self.fd, 0)
+        os.write(self.fd, data)
+        os.close(self.fd)
+
+def speaker_output(volumes):
+    lines = ["Simple mixer control 'Speaker',0",
+        "  Capabilities: pvolume pswitch",
+        f"  Playback channels: {' - '.join(SPEAKER_CHANNELS)}",
+        f"  Limits: Playback 0 - {SPEAKER_MAX}",
+        "  Mono:"]
+    for name, volume in zip(SPEAKER_CHANNELS, volumes):
+        lines.append(f"  {name}: Playback {round(volume*SPEAKER_MAX/100)} [{volume}%] [-20.00dB] [on]")
+    return "\n".join(lines) + "\n"
+
+def eq_output(settings):
+    lines = []
+    for name, setting in zip(EQ_CHANNELS, settings):
+        lines += [f"Simple mixer control '{name}',0",
+            "  Capabilities: pvolume",
+            "  Playback channels: Front Left - Front Right",
+            "  Limits: Playback 0 - 100",
+            "  Mono:",
+            f"  Front Left: Playback {setting} [{setting}%]",
+            f"  Front Right: Playback {setting} [{setting}%]"]
+    return "\n".join(lines) + "\n"
+
+# "65%" or "65" sets, "0%+" or "0+" keeps the value
+def apply_value(current, value):
+    match = re.fullmatch(r"(\d+)%?([+-]?)", value)
+    if match is None:
+        return current
+    number, sign = int(match.group(1)), match.group(2)
+    if sign == "+":
+        return min(100, current + number)
+    if sign == "-":
+        return max(0, current - number)
+    return min(100, number)
+
+def amixer(args):
+    device = args[args.index("-D")+1]
+    with MixerState() as state:
+        if device.endswith("_eq"):
+            settings = state.get(device, len(EQ_CHANNELS), 66)
+            if "-s" in args:
+                # sset '00. 31 Hz' 66
+                for line in sys.stdin.read().splitlines():
+                    match = re.fullmatch(r"sset '(.+)' (\S+)", line.strip())
+                    if match is not None and match.group(1) in EQ_CHANNELS:
+                        index = EQ_CHANNELS.index(match.group(1))
+                        settings[index] = apply_value(settings[index], match.group(2))
+            sys.stdout.write(eq_output(settings))
+        else:
+            volumes = state.get(device, len(SPEAKER_CHANNELS), 50)
+            if "set" in args:
+                values = args[args.index("Speaker")+1].split(",")
+                for index, value in enumerate(values[:len(volumes)]):
+                    volumes[index] = apply_value(volumes[index], value)
+            sys.stdout.write(speaker_output(volumes))
+
+def alsactl(args):
+    pass
+
+def compose_config(args):
+    services = {
+        "supervisor": {"image": "ghcr.io/aschamberger/sma-supervisor:latest", "build": {"context": "."}},
+        "squeezelite_tpl": {"image": "ghcr.io/aschamberger/squeezelite:latest", "build": {"context": "."}},
+    }
+    for channel in range(1, NUM_CHANNELS+1):
+        variable = "${OUTPUT_CH%d}" % channel if "--no-interpolate" in args else f"ch{channel}_eq"
+        services[f"squeezelite{channel}"] = {
+            "image": "ghcr.io/aschamberger/squeezelite:latest",
+            "build": {"context": "."},
+            "profiles": ["on"],
+            "environment": {"OUTPUT": variable},
+        }
+    return json.dumps({"name": "sma", "services": services}) + "\n"
+
+def docker(args):
+    if args[:1] == ["compose"]:
+        if "--profiles" in args:
+            sys.stdout.write("on\n")
+        elif "config" in args:
+            sys.stdout.write(compose_config(args))
+        elif "up" in args:
+            services = [arg for arg in args[args.index("up")+1:] if not arg.startswith("-")]
+            for service in services or [f"squeezelite{channel}" for channel in range(1, NUM_CHANNELS+1)]:
+                sys.stdout.write(f" Container {service}  Started\n")
+    elif args[:1] == ["ps"]:
+        for channel in range(1, NUM_CHANNELS+1):
+            sys.stdout.write(f"squeezelite{channel}:running\n")
+        sys.stdout.write("supervisor:running\n")
+    elif args[:1] in (["images"], ["inspect"]):
+        sys.stdout.write("sha256:0000000000000000000000000000000000000000000000000000000000000000\n")
+    elif args[:2] == ["image", "inspect"]:
+        sys.stdout.write(f"{args[-1].rpartition(':')[0]}@sha256:{'1'*64}\n")
+    elif args[:2] == ["image", "prune"]:
+        sys.stdout.write("Total reclaimed space: 0B\n")
+    elif args[:1] == ["pull"]:
+        sys.stdout.write(f"{args[1]}: Pulling from fake\nStatus: Image is up to date\n")
+    else:
+        sys.stderr.write(f"fake docker: unsupported command {' '.join(args)}\n")
+        sys.exit(1)
+
+def sshpass(args):
+    # sshpass -e ssh ..., the password is only checked to be there
+    if "SSHPASS" not in os.environ:
+        sys.exit("fake sshpass: SSHPASS not set")
+    os.execvp(args[1], args[1:])
+
+def ssh(args):
+    # ssh [-o option]... [-p port] user@host command, all options take a value
+    index = 0
+    while args[index].startswith("-"):
+        index += 2
+    command = " ".join(args[index+1:])
+    kbps = int(os.environ.get("FAKE_SSH_KBPS", "0"))
+    if not kbps or not command.startswith("cat > "):
+        sys.exit(subprocess.run(["sh", "-c", command]).returncode)
+    # only the upload reads stdin, it is passed on at the given bandwidth
+    remote = subprocess.Popen(["sh", "-c", command], stdin=subprocess.PIPE)
+    start = time.monotonic()
+    sent = 0
+    while chunk := os.read(0, 65536):
+        remote.stdin.write(chunk)
+        sent += len(chunk)
+        delay = sent/(kbps*1024) - (time.monotonic() - start)
+        if delay > 0:
+            time.sleep(delay)
+    remote.stdin.close()
+    sys.exit(remote.wait())
+
+programs = {
+    "amixer": amixer,
+    "alsactl": alsactl,
+    "docker": docker,
+    "ssh": ssh,
+    "sshpass": sshpass,
+}
+
+def main():
+    program = os.path.basename(sys.argv[0])
+    if program not in programs:
+        sys.exit(f"fakebin: call as one of {', '.join(programs)}")
+    log_call(program, sys.argv[1:])
+    latency(program)
+    programs[program](sys.argv[1:])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,222 @@
+#!/usr/bin/python3
+
+# local stand-ins for the services the supervisor talks to over the network or the bus:
+# LMS JSON-RPC, docker engine API on a unix socket and io.gpiod1, login1 and systemd1
+# on a private D-Bus daemon
+#
+#   FAKE_LMS_LATENCY_MS, FAKE_DOCKER_LATENCY_MS, FAKE_DBUS_LATENCY_MS delay every request,
+#   every request is appended to the call log next to the fake programs' calls
+
+from aiohttp import web
+from dbus_fast.aio import MessageBus
+from dbus_fast.service import PropertyAccess, ServiceInterface, dbus_property, method, signal
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fakebin
+
+NUM_CHANNELS = 8
+NUM_LINES = 28 # gpiochip0 of a Pi
+
+def latency(service):
+    return int(os.environ.get(f"FAKE_{service.upper()}_LATENCY_MS", os.environ.get("FAKE_LATENCY_MS", "0")))/1000
+
+# LMS, names are kept per player mac and start from the squeezelite name files
+def lms_app(name_dir):
+    names = {}
+    for channel in range(1, NUM_CHANNELS+1):
+        with open(f"{name_dir}/squeeze{channel}.name") as f:
+            names[f"02:00:00:00:00:{channel:02d}"] = f.read()
+
+    async def jsonrpc(request):
+        data = json.loads(await request.read())
+        player, command = data["params"]
+        fakebin.log_call("lms", [player] + command)
+        await asyncio.sleep(latency("lms"))
+        result = {}
+        if command[:1] == ["name"] and player in names:
+            if command[1] == "?":
+                result = {"_value": names[player]}
+            else:
+                names[player] = command[1]
+        return web.json_response({"id": data["id"], "method": data["method"], "params": data["params"], "result": result})
+
+    app = web.Application()
+    app.router.add_post("/jsonrpc.js", jsonrpc)
+    return app
+
+# docker engine, all containers are running and the event stream stays open without events
+def docker_app():
+    containers = ["supervisor"] + [f"squeezelite{channel}" for channel in range(1, NUM_CHANNELS+1)]
+    image_id = "sha256:" + "0"*64
+
+    @web.middleware
+    async def log_request(request, handler):
+        fakebin.log_call("docker-engine", [request.method, request.path])
+        await asyncio.sleep(latency("docker"))
+        return await handler(request)
+
+    async def container_list(request):
+        return web.json_response([{"Names": [f"/{name}"], "State": "running"} for name in containers])
+
+    async def container_inspect(request):
+        if request.match_info["name"] not in containers:
+            return web.json_response({"message": "No such container"}, status=404)
+        return web.json_response({"Image": image_id})
+
+    async def image_inspect(request):
+        repository = request.match_info["name"].rpartition(":")[0]
+        return web.json_response({"Id": image_id, "RepoDigests": [f"{repository}@sha256:{'1'*64}"]})
+
+    async def image_create(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        await response.write(b'{"status":"Status: Image is up to date"}\r\n')
+        return response
+
+    async def image_prune(request):
+        return web.json_response({"ImagesDeleted": None, "SpaceReclaimed": 0})
+
+    async def events(request):
+        response = web.StreamResponse()
+        await response.prepare(request)
+        while True:
+            await asyncio.sleep(3600)
+
+    app = web.Application(middlewares=[log_request])
+    app.router.add_get("/containers/json", container_list)
+    app.router.add_get("/containers/{name}/json", container_inspect)
+    app.router.add_get("/images/{name:.*}/json", image_inspect)
+    app.router.add_post("/images/create", image_create)
+    app.router.add_post("/images/prune", image_prune)
+    app.router.add_get("/events", events)
+    return app
+
+# io.gpiod1 as served by gpio-manager, one chip with all lines unrequested at start
+class GpioLine(ServiceInterface):
+    def __init__(self, offset):
+        super().__init__("io.gpiod1.Line")
+        self.offset = offset
+        self.request_path = "/"
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Offset(self) -> "u":
+        return self.offset
+
+    @dbus_property(access=PropertyAccess.READ)
+    def Managed(self) -> "b":
+        return self.request_path != "/"
+
+    @dbus_property(access=PropertyAccess.READ)
+    def RequestPath(self) -> "o":
+        return self.request_path
+
+    @signal()
+    def EdgeEvent(self, event) -> "(ittt)":
+        return event
+
+class GpioRequest(ServiceInterface):
+    def __init__(self, values):
+        super().__init__("io.gpiod1.Request")
+        self.values = values
+
+    @method()
+    async def GetValues(self, offsets: "au") -> "ai":
+        fakebin.log_call("dbus", ["GetValues"] + [str(offset) for offset in offsets])
+        await asyncio.sleep(latency("dbus"))
+        return [self.values.get(offset, 0) for offset in offsets]
+
+    @method()
+    async def SetValues(self, values: "a{ui}"):
+        fakebin.log_call("dbus", ["SetValues"] + [f"{offset}={value}" for offset, value in values.items()])
+        await asyncio.sleep(latency("dbus"))
+        self.values.update(values)
+
+class GpioChip(ServiceInterface):
+    def __init__(self, bus):
+        super().__init__("io.gpiod1.Chip")
+        self.bus = bus
+        self.requests = 0
+        self.values = {}
+        self.lines = {}
+        for offset in range(NUM_LINES):
+            self.lines[offset] = GpioLine(offset)
+            bus.export(f"/io/gpiod1/chips/gpiochip0/line{offset}", self.lines[offset])
+
+    @method()
+    async def RequestLines(self, line_config: "(a(aua{sv})ai)", options: "a{sv}") -> "o":
+        offsets = [offset for line_offsets, settings in line_config[0] for offset in line_offsets]
+        fakebin.log_call("dbus", ["RequestLines"] + [str(offset) for offset in offsets])
+        await asyncio.sleep(latency("dbus"))
+        self.requests += 1
+        path = f"/io/gpiod1/requests/request{self.requests}"
+        self.bus.export(path, GpioRequest(self.values))
+        for offset, value in zip(offsets, line_config[1]):
+            self.values[offset] = value
+        for offset in offsets:
+            line = self.lines[offset]
+            line.request_path = path
+            line.emit_properties_changed({"RequestPath": path, "Managed": True})
+        return path
+
+class Login1Manager(ServiceInterface):
+    def __init__(self):
+        super().__init__("org.freedesktop.login1.Manager")
+
+    @method()
+    def PowerOff(self, interactive: "b"):
+        fakebin.log_call("dbus", ["PowerOff"])
+
+    @method()
+    def Reboot(self, interactive: "b"):
+        fakebin.log_call("dbus", ["Reboot"])
+
+class Systemd1Manager(ServiceInterface):
+    def __init__(self):
+        super().__init__("org.freedesktop.systemd1.Manager")
+
+    @method()
+    def StartUnit(self, name: "s", mode: "s") -> "o":
+        fakebin.log_call("dbus", ["StartUnit", name])
+        return "/org/freedesktop/systemd1/job/1"
+
+async def serve_dbus(bus_address):
+    bus = await MessageBus(bus_address=bus_address).connect()
+    bus.export("/io/gpiod1/chips/gpiochip0", GpioChip(bus))
+    bus.export("/org/freedesktop/login1", Login1Manager())
+    bus.export("/org/freedesktop/systemd1", Systemd1Manager())
+    for name in ("io.gpiod1", "org.freedesktop.login1", "org.freedesktop.systemd1"):
+        await bus.request_name(name)
+    return bus
+
+async def serve(args):
+    lms_runner = web.AppRunner(lms_app(args.name_dir), access_log=None)
+    await lms_runner.setup()
+    await web.TCPSite(lms_runner, "127.0.0.1", args.lms_port).start()
+    docker_runner = web.AppRunner(docker_app(), access_log=None)
+    await docker_runner.setup()
+    await web.UnixSite(docker_runner, args.docker_socket).start()
+    bus = await serve_dbus(args.bus_address)
+    print("Fake services ready", flush=True)
+    try:
+        await bus.wait_for_disconnect()
+    finally:
+        await lms_runner.cleanup()
+        await docker_runner.cleanup()
+
+def main():
+    parser = argparse.ArgumentParser(description="fake LMS, docker engine and D-Bus services")
+    parser.add_argument("--name-dir", required=True, help="squeezelite name files the LMS player names start from")
+    parser.add_argument("--lms-port", type=int, required=True)
+    parser.add_argument("--docker-socket", required=True)
+    parser.add_argument("--bus-address", required=True, help="private bus, e.g. unix:path=/tmp/bus")
+    asyncio.run(serve(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+#!/usr/bin/python3
+
+# end-to-end load test of supervisor.main against local stand-ins: fake amixer, alsactl and docker
+# on PATH, a fake LMS and docker engine, io.gpiod1/login1/systemd1 on a private D-Bus daemon, a fake
+# sysfs USB tree and a local mosquitto. The traffic generator replays slider bursts, preset storms and
+# Home Assistant restarts and measures command to state latency, dropped and late states and the
+# calls to every stand-in.
+#
+#   python3 loadtest/loadtest.py                          all scenarios with default load
+#   python3 loadtest/loadtest.py --amixer-latency 80      slow mixer, e.g. a busy USB bus
+#   python3 loadtest/loadtest.py --mqtt-host 127.0.0.1:1883 --scenarios sliders
+
+import argparse
+import asyncio
+import collections
+import json
+import math
+import os
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+loadtestDir = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.dirname(loadtestDir))
+
+import aiomqtt
+import recovery
+from config import discovery_prefix, eq_presets, node_id, num_channels
+
+STARTUP_TIMEOUT = 90 # seconds, the supervisor waits 20 seconds for the USB DACs before publishing volumes
+SERVICE_TIMEOUT = 10 # seconds
+SCENARIOS = ["sliders", "presets", "restarts"]
+PROGRAMS = ["amixer", "alsactl", "docker", "docker-engine", "lms", "dbus"]
+# board numbers of the test env file, see gpio._BOARD_MAP
+GPIO_MUTES = [11, 12, 13, 15, 16, 18, 22, 29]
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def player_name(channel):
+    return f"Load Test {channel}"
+
+def write_file(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(content)
+
+# env file, squeezelite name files, sysfs USB tree with hub and both DACs and the bus config
+def write_environment(root, lms_port, mqtt_host):
+    env = {
+        "LMS_HOST": f"127.0.0.1:{lms_port}",
+        "MQTT_HOST": mqtt_host,
+        "HASS_HOST": "127.0.0.1:8123",
+        "GPIO_PSU_RELAY": "7",
+        "PSU_POWER_ON_DELAY": "2",
+        "PSU_POWER_DOWN_DELAY": "5",
+        "GPIO_USB_POWER": "26",
+        "METRICS_PORT": "0",
+        # backups only after config changes and without a backup host never
+        "BACKUP_INTERVAL": "0",
+    }
+    for channel in range(1, num_channels+1):
+        env[f"OUTPUT_CH{channel}"] = f"ch{channel}_eq"
+        env[f"HASS_SWITCH_CH{channel}"] = f"switch.sound_ch{channel}"
+        env[f"GPIO_CH{channel}_MUTE"] = str(GPIO_MUTES[channel-1])
+        write_file(f"{root}/squeezelite/squeeze{channel}.name", player_name(channel))
+    write_file(f"{root}/compose/.env", "".join(f"{key}={value}\n" for key, value in env.items()))
+    os.makedirs(f"{root}/compose/.cache", exist_ok=True)
+
+    devices = {
+        "1-1": (recovery.usb_id_hub, 2),
+        "1-1.1": (recovery.usb_id_dacs, 3),
+        "1-1.2": (recovery.usb_id_dacs, 4),
+    }
+    for name, ((vendor, product), devnum) in devices.items():
+        write_file(f"{root}/sysfs/{name}/idVendor", f"{vendor:04x}\n")
+        write_file(f"{root}/sysfs/{name}/idProduct", f"{product:04x}\n")
+        write_file(f"{root}/sysfs/{name}/busnum", "1\n")
+        write_file(f"{root}/sysfs/{name}/devnum", f"{devnum}\n")
+    # interfaces have no ids and are skipped by the inventory
+    os.makedirs(f"{root}/sysfs/1-1.1:1.0", exist_ok=True)
+
+    write_file(f"{root}/dbus.conf", f"""<!DOCTYPE busconfig PUBLIC "-//freedesktop//DTD D-Bus Bus Configuration 1.0//EN"
+ "http://www.freedesktop.org/standards/dbus/1.0/busconfig.dtd">
+<busconfig>
+  <type>session</type>
+  <listen>unix:path={root}/bus</listen>
+  <auth>EXTERNAL</auth>
+  <policy context="default">
+    <allow send_destination="*" eavesdrop="true"/>
+    <allow eavesdrop="true"/>
+    <allow own="*"/>
+  </policy>
+</busconfig>
+""")
+
+def wait_for(condition, process, name, timeout=SERVICE_TIMEOUT):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if process.poll() is not None:
+            sys.exit(f"{name} exited with {process.returncode}")
+        if time.monotonic() > deadline:
+            sys.exit(f"{name} not ready after {timeout} seconds")
+        time.sleep(0.05)
+
+def log_contains(path, text):
+    with open(path) as f:
+        return text in f.read()
+
+def port_open(port):
+    with socket.socket() as s:
+        return s.connect_ex(("127.0.0.1", port)) == 0
+
+# starts the bus, the broker, the fake services and the supervisor, their output goes to <root>/*.log
+class Stack:
+    def __init__(self, root, args):
+        self.root = root
+        self.args = args
+        self.processes = []
+
+    def start(self, name, program, env=None, cwd=None):
+        log = open(f"{self.root}/{name}.log", "w")
+        process = subprocess.Popen(program, stdout=log, stderr=subprocess.STDOUT, env=env, cwd=cwd)
+        self.processes.append((name, process))
+        return process
+
+    def up(self):
+        args = self.args
+        lms_port = free_port()
+        mqtt_host = args.mqtt_host
+        if mqtt_host is None:
+            if shutil.which("mosquitto") is None:
+                sys.exit("mosquitto not found, install it or pass --mqtt-host of a broker to use")
+            mqtt_port = free_port()
+            mqtt_host = f"127.0.0.1:{mqtt_port}"
+        write_environment(self.root, lms_port, mqtt_host)
+
+        if args.mqtt_host is None:
+            write_file(f"{self.root}/mosquitto.conf", f"listener {mqtt_port} 127.0.0.1\nallow_anonymous true\n")
+            process = self.start("mosquitto", ["mosquitto", "-c", f"{self.root}/mosquitto.conf"])
+            wait_for(lambda: port_open(mqtt_port), process, "mosquitto")
+
+        process = self.start("dbus-daemon", ["dbus-daemon", "--nofork", f"--config-file={self.root}/dbus.conf"])
+        wait_for(lambda: os.path.exists(f"{self.root}/bus"), process, "dbus-daemon")
+
+        env = dict(os.environ,
+            PATH=f"{loadtestDir}/bin{os.pathsep}{os.environ['PATH']}",
+            PYTHONUNBUFFERED="1",
+            FAKE_STATE_DIR=self.root,
+            SYSFS_USB_DEVICES=f"{self.root}/sysfs",
+            DOCKER_HOST=f"unix://{self.root}/docker.sock",
+            DBUS_SYSTEM_BUS_ADDRESS=f"unix:path={self.root}/bus")
+        for program in ("amixer", "alsactl", "docker", "lms", "dbus"):
+            env[f"FAKE_{program.upper()}_LATENCY_MS"] = str(getattr(args, f"{program}_latency"))
+
+        process = self.start("fakes", [sys.executable, f"{loadtestDir}/fakes.py",
+            "--name-dir", f"{self.root}/squeezelite", "--lms-port", str(lms_port),
+            "--docker-socket", f"{self.root}/docker.sock", "--bus-address", env["DBUS_SYSTEM_BUS_ADDRESS"]], env)
+        wait_for(lambda: log_contains(f"{self.root}/fakes.log", "Fake services ready"), process, "fake services")
+
+        self.start("supervisor", [sys.executable, f"{loadtestDir}/run_supervisor.py", self.root], env, self.root)
+        return mqtt_host
+
+    def supervisor_running(self):
+        return all(process.poll() is None for name, process in self.processes if name == "supervisor")
+
+    def down(self):
+        for name, process in reversed(self.processes):
+            if process.poll() is None:
+                process.terminate()
+                try:
+                    process.wait(5)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.wait()
+
+# calls of the fake programs and services since the last call, by program
+class CallCounter:
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def take(self):
+        counts = collections.Counter()
+        try:
+            with open(self.path) as f:
+                f.seek(self.offset)
+                for line in f:
+                    counts[line.split()[1]] += 1
+                self.offset = f.tell()
+        except FileNotFoundError:
+            pass
+        return counts
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+def state_topic(component, object_id):
+    return f"{discovery_prefix}/{component}/{node_id}/{node_id}_{object_id}/state"
+
+def command_topic(component, object_id):
+    return f"{discovery_prefix}/{component}/{node_id}/{node_id}_{object_id}/set"
+
+_EQ_TOPIC = re.compile(r"_ch(\d\d)_eq(\d\d)_eqsetting/state$")
+
+# expected states per topic in command order, a state matches the oldest expectation with its payload
+class Tracker:
+    def __init__(self):
+        self.pending = collections.defaultdict(collections.deque)
+        self.eq_settings = collections.defaultdict(lambda: [None]*10)
+        self.received = {}
+        self.first = {}
+
+    def expect(self, key, payload, sent):
+        entry = {"payload": payload, "sent": sent, "latency": None}
+        self.pending[key].append(entry)
+        return entry
+
+    def _match(self, key, payload, now):
+        for entry in self.pending.get(key, ()):
+            if entry["payload"] == payload:
+                entry["latency"] = now - entry["sent"]
+                self.pending[key].remove(entry)
+                return
+
+    def on_message(self, topic, payload, now):
+        self.received[topic] = payload
+        self.first.setdefault(topic, now)
+        self._match(topic, payload, now)
+        # presets are published as ten eq settings, the preset is applied once the last one arrived
+        match = _EQ_TOPIC.search(topic)
+        if match is not None:
+            channel, eq_channel = int(match.group(1)), int(match.group(2))
+            self.eq_settings[channel][eq_channel] = payload
+            if eq_channel == 9:
+                self._match(f"ch{channel:02d}_eqpreset", tuple(self.eq_settings[channel]), now)
+
+    def outstanding(self, entries):
+        return [entry for entry in entries if entry["latency"] is None]
+
+async def settle(tracker, entries, timeout):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while tracker.outstanding(entries) and asyncio.get_running_loop().time() < deadline:
+        await asyncio.sleep(0.05)
+
+# slider drags: a run of distinct volumes on one channel at the slider's update rate
+async def slider_bursts(client, tracker, args):
+    loop = asyncio.get_running_loop()
+    entries = []
+    for burst in range(args.bursts):
+        channel = burst % num_channels + 1
+        start = 10 + 7*burst % 40
+        for step in range(args.burst_size):
+            volume = str(start + step)
+            entries.append(tracker.expect(state_topic("number", f"ch{channel:02d}_volume"), volume, loop.time()))
+            await client.publish(command_topic("number", f"ch{channel:02d}_volume"), payload=volume)
+            await asyncio.sleep(args.slider_interval)
+        await asyncio.sleep(args.pause)
+    return entries
+
+# preset buttons pressed across all channels in quick succession
+async def preset_storm(client, tracker, args):
+    loop = asyncio.get_running_loop()
+    names = list(eq_presets)
+    entries = []
+    for press in range(args.presets):
+        channel = press % num_channels + 1
+        # a different preset than the previous press on the same channel
+        name = names[(press // num_channels + channel) % len(names)]
+        entries.append(tracker.expect(f"ch{channel:02d}_eqpreset", tuple(eq_presets[name]), loop.time()))
+        await client.publish(f"{discovery_prefix}/button/{node_id}/{node_id}_ch{channel:02d}_eqpreset/set", payload=name)
+        await asyncio.sleep(args.preset_interval)
+    return entries
+
+# Home Assistant coming back online makes the supervisor republish all states, the player names are
+# published last; a slider move right after it shows how long commands wait behind the republish
+async def ha_restarts(client, tracker, args):
+    loop = asyncio.get_running_loop()
+    entries = []
+    for restart in range(args.restarts):
+        entries.append(tracker.expect(state_topic("text", f"ch{num_channels:02d}_player_name"),
+            player_name(num_channels), loop.time()))
+        await client.publish("homeassistant/status", payload="online")
+        volume = str(60 + restart)
+        entries.append(tracker.expect(state_topic("number", "ch01_volume"), volume, loop.time()))
+        await client.publish(command_topic("number", "ch01_volume"), payload=volume)
+        await settle(tracker, entries, args.timeout)
+        await asyncio.sleep(args.pause)
+    return entries
+
+scenarios = {
+    "sliders": slider_bursts,
+    "presets": preset_storm,
+    "restarts": ha_restarts,
+}
+
+def summarize(name, entries, calls, duration, deadline):
+    latencies = [entry["latency"] for entry in entries if entry["latency"] is not None]
+    result = {
+        "scenario": name,
+        "commands": len(entries),
+        "dropped": len(entries) - len(latencies),
+        "late": sum(1 for latency in latencies if latency > deadline),
+        "duration": round(duration, 3),
+        "calls": {program: calls.get(program, 0) for program in PROGRAMS},
+    }
+    for p in (50, 95, 99, 100):
+        result[f"p{p}_ms"] = round(1000*percentile(latencies, p), 1) if latencies else None
+    return result
+
+def print_report(results, startup):
+    print(f"supervisor ready after {startup:.1f} s\n")
+    print(f"{'scenario':10} {'cmds':>5} {'dropped':>7} {'late':>5} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'max ms':>8}")
+    for result in results:
+        latencies = [f"{result[f'p{p}_ms']:8.1f}" if result[f"p{p}_ms"] is not None else f"{'-':>8}" for p in (50, 95, 99, 100)]
+        print(f"{result['scenario']:10} {result['commands']:5d} {result['dropped']:7d} {result['late']:5d} {' '.join(latencies)}")
+    print(f"\n{'calls':10} " + " ".join(f"{program:>13}" for program in PROGRAMS))
+    for result in results:
+        print(f"{result['scenario']:10} " + " ".join(f"{result['calls'][program]:13d}" for program in PROGRAMS))
+
+async def generate(args, mqtt_host, stack, calls):
+    host, port = mqtt_host.split(":")
+    tracker = Tracker()
+    async with aiomqtt.Client(hostname=host, port=int(port)) as client:
+        await client.subscribe(f"{discovery_prefix}/+/{node_id}/+/state")
+
+        async def receive():
+            async for message in client.messages:
+                tracker.on_message(str(message.topic), message.payload.decode(), asyncio.get_running_loop().time())
+
+        receiver = asyncio.create_task(receive())
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        ready_topic = state_topic("number", "ch01_volume")
+        while ready_topic not in tracker.received:
+            if not stack.supervisor_running():
+                sys.exit("supervisor exited, see supervisor.log")
+            if loop.time() - started > STARTUP_TIMEOUT:
+                sys.exit(f"no volume state after {STARTUP_TIMEOUT} seconds, see supervisor.log")
+            await asyncio.sleep(0.1)
+        startup = loop.time() - started
+        # let the startup publishing finish before measuring
+        await asyncio.sleep(2)
+        calls.take()
+
+        results = []
+        for name in args.scenarios:
+            start = loop.time()
+            entries = await scenarios[name](client, tracker, args)
+            await settle(tracker, entries, args.timeout)
+            results.append(summarize(name, entries, calls.take(), loop.time() - start, args.deadline))
+            await asyncio.sleep(args.pause)
+
+        receiver.cancel()
+    return startup, results
+
+def main():
+    parser = argparse.ArgumentParser(description="end-to-end load test of the supervisor with local stand-ins")
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument("--mqtt-host", help="host:port of a broker to use instead of starting mosquitto")
+    parser.add_argument("--bursts", type=int, default=8, help="slider bursts, default 8")
+    parser.add_argument("--burst-size", type=int, default=20, help="volume commands per burst, default 20")
+    parser.add_argument("--slider-interval", type=float, default=0.05, help="seconds between slider commands, default 0.05")
+    parser.add_argument("--presets", type=int, default=40, help="preset presses, default 40")
+    parser.add_argument("--preset-interval", type=float, default=0.02, help="seconds between preset presses, default 0.02")
+    parser.add_argument("--restarts", type=int, default=3, help="Home Assistant restarts, default 3")
+    parser.add_argument("--pause", type=float, default=1, help="seconds between bursts and scenarios, default 1")
+    parser.add_argument("--deadline", type=float, default=1, help="seconds after which a state counts as late, default 1")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds after which a state counts as dropped, default 30")
+    for program in ("amixer", "alsactl", "docker", "lms", "dbus"):
+        parser.add_argument(f"--{program}-latency", type=int, default=0, metavar="MS", help=f"added latency of the fake {program}")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--keep", action="store_true", help="keep the environment with the logs and call log")
+    args = parser.parse_args()
+
+    root = tempfile.mkdtemp(prefix="sma-loadtest-")
+    stack = Stack(root, args)
+    try:
+        mqtt_host = stack.up()
+        startup, results = asyncio.run(generate(args, mqtt_host, stack, CallCounter(f"{root}/calls.log")))
+    finally:
+        stack.down()
+        if args.keep:
+            print(f"Environment and logs kept in {root}")
+        else:
+            shutil.rmtree(root, ignore_errors=True)
+
+    print_report(results, startup)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"startup": round(startup, 3), "args": vars(args), "results": results}, f, indent=2)
+            f.write("\n")
+    if any(result["dropped"] for result in results):
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+# runs supervisor.start() against a load test environment instead of /etc/opt:
+#   <root>/compose/.env, <root>/compose/.cache and <root>/squeezelite/squeezeN.name
+# PATH, SYSFS_USB_DEVICES, DOCKER_HOST and DBUS_SYSTEM_BUS_ADDRESS are set by loadtest.py
+
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import backup
+import compose
+import config
+import offload
+import registry
+import supervisor
+
+def main():
+    root = sys.argv[1]
+    cache_dir = f"{root}/compose/.cache"
+    compose.envFile = f"{root}/compose/.env"
+    offload.nameFilePath = f"{root}/squeezelite"
+    # the modules import cache_dir by name and derive their cache files from it on import
+    for module in (config, backup, registry):
+        module.cache_dir = cache_dir
+    backup.envFile = compose.envFile
+    backup.backupFiles = [compose.envFile, offload.nameFilePath]
+    backup.manifestFile = f"{cache_dir}/backup.json"
+    registry.cacheFile = f"{cache_dir}/registry.json"
+
+    print('Starting supervisor', flush=True)
+    asyncio.run(supervisor.start())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# event loop lag sampler and blocking call detector, anything that blocks the loop delays
+# every MQTT command and state update behind it
+
+import asyncio
+import sys
+import threading
+import time
+import traceback
+
+import metrics
+
+SAMPLE_INTERVAL = 0.25 # seconds
+
+class LagMonitor:
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.max_lag = 0.0
+
+    # the lag is how much later than scheduled a sleep returns
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - start - self.interval)
+            self.max_lag = max(self.max_lag, lag)
+            metrics.observe("sma_loop_lag_seconds", lag)
+
+    # returns the maximum lag since the last call
+    def take_max(self):
+        max_lag = self.max_lag
+        self.max_lag = 0.0
+        return max_lag
+
+# a thread pings the loop and prints the loop thread's stack if the ping is not answered
+# within threshold seconds, so the blocking call shows up with its caller
+class BlockingDetector:
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._watch, name="blocking-detector", daemon=True)
+        self.thread.start()
+
+    def _watch(self):
+        while not self.stopped.is_set():
+            answered = threading.Event()
+            start = time.monotonic()
+            try:
+                self.loop.call_soon_threadsafe(answered.set)
+            except RuntimeError:
+                # loop closed
+                return
+            if not answered.wait(self.threshold):
+                frame = sys._current_frames().get(self.thread_id)
+                stack = "".join(traceback.format_stack(frame)) if frame is not None else ""
+                # report once per stall, with its duration when the loop is back
+                while not answered.wait(1) and not self.stopped.is_set():
+                    pass
+                print(f"Event loop blocked for {time.monotonic() - start:.3f} seconds in:\n{stack}")
+            self.stopped.wait(self.threshold)
+
+    def stop(self):
+        self.stopped.set()
+
+async def main():
+    print('loop lag test')
+
+    monitor = LagMonitor()
+    task = asyncio.create_task(monitor.run())
+    detector = BlockingDetector(0.1)
+    await asyncio.sleep(0.5)
+    time.sleep(0.3)
+    await asyncio.sleep(0.5)
+    print(f"max lag {monitor.take_max():.3f} seconds")
+    detector.stop()
+    task.cancel()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,172 @@
+#!/usr/bin/python3
+
+# in-process latency histograms and counters, exposed as OpenMetrics text on a local port
+# https://github.com/OpenObservability/OpenMetrics/blob/main/specification/OpenMetrics.md
+
+from aiohttp import web
+
+import aiohttp
+import asyncio
+import bisect
+import collections
+import contextlib
+import math
+import time
+
+# seconds, from a single D-Bus call up to a docker compose recreate
+BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+# recent samples per series for the percentile summary
+RESERVOIR_SIZE = 512
+
+CONTENT_TYPE = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+
+class Histogram:
+    def __init__(self):
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.recent = collections.deque(maxlen=RESERVOIR_SIZE)
+
+    def observe(self, value):
+        self.buckets[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+
+    def percentile(self, p):
+        if not self.recent:
+            return None
+        values = sorted(self.recent)
+        return values[min(len(values) - 1, math.ceil(p / 100 * len(values)) - 1)]
+
+# name -> help text, name -> {labels: Histogram or count}
+_help = {}
+_histograms = collections.defaultdict(dict)
+_counters = collections.defaultdict(dict)
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def describe(name, text):
+    _help[name] = text
+
+def observe(name, value, **labels):
+    series = _histograms[name]
+    key = _labels(labels)
+    if key not in series:
+        series[key] = Histogram()
+    series[key].observe(value)
+
+def inc(name, value=1, **labels):
+    series = _counters[name]
+    key = _labels(labels)
+    series[key] = series.get(key, 0) + value
+
+# times the block into the {name}_seconds histogram and counts exceptions in {name}_errors
+@contextlib.contextmanager
+def timed(name, **labels):
+    start = time.monotonic()
+    try:
+        yield
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        inc(f"{name}_errors", **labels)
+        raise
+    finally:
+        observe(f"{name}_seconds", time.monotonic() - start, **labels)
+
+# per series percentiles of the recent samples, e.g. {"set_volume": {"p50": 0.01, "p99": 0.2}}
+def percentiles(name, label, ps=(50, 99)):
+    summary = {}
+    for key, histogram in _histograms.get(name, {}).items():
+        summary[dict(key).get(label)] = {f"p{p}": histogram.percentile(p) for p in ps}
+    return summary
+
+def http_trace_config(client):
+    # times every request of a client session, labelled with the client name and method
+    async def on_request_start(session, context, params):
+        context.start = time.monotonic()
+
+    async def on_request_end(session, context, params):
+        observe("sma_http_request_seconds", time.monotonic() - context.start,
+            client=client, method=params.method)
+        if params.response.status >= 400:
+            inc("sma_http_request_errors", client=client, method=params.method)
+
+    async def on_request_exception(session, context, params):
+        observe("sma_http_request_seconds", time.monotonic() - context.start,
+            client=client, method=params.method)
+        inc("sma_http_request_errors", client=client, method=params.method)
+
+    trace_config = aiohttp.TraceConfig()
+    trace_config.on_request_start.append(on_request_start)
+    trace_config.on_request_end.append(on_request_end)
+    trace_config.on_request_exception.append(on_request_exception)
+    return trace_config
+
+def _format_labels(key, extra=()):
+    labels = list(key) + list(extra)
+    if not labels:
+        return ""
+    escaped = [(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in labels]
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+def render():
+    lines = []
+    for name in sorted(_histograms):
+        family = name.removesuffix("_seconds")
+        lines.append(f"# TYPE {name} histogram")
+        lines.append(f"# UNIT {name} seconds")
+        if family in _help:
+            lines.append(f"# HELP {name} {_help[family]}")
+        for key, histogram in sorted(_histograms[name].items()):
+            cumulative = 0
+            for bound, count in zip([float(bound) for bound in BUCKETS] + ["+Inf"], histogram.buckets):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(key, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_count{_format_labels(key)} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(key)} {histogram.sum}")
+    for name in sorted(_counters):
+        lines.append(f"# TYPE {name} counter")
+        if name in _help:
+            lines.append(f"# HELP {name} {_help[name]}")
+        for key, value in sorted(_counters[name].items()):
+            lines.append(f"{name}_total{_format_labels(key)} {value}")
+    lines.append("# EOF")
+    return "\n".join(lines) + "\n"
+
+async def handle_metrics(request):
+    return web.Response(body=render().encode(), headers={"Content-Type": CONTENT_TYPE})
+
+# returns the runner to clean up, None if port is 0
+async def start_server(port, host="127.0.0.1"):
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"Metrics available on http://{host}:{port}/metrics")
+    return runner
+
+describe("sma_mqtt_handler", "MQTT command handling until the new state is published")
+describe("sma_subprocess", "External program runs")
+describe("sma_dbus_call", "D-Bus method calls on the system bus")
+describe("sma_http_request", "HTTP requests to LMS, docker engine and container registry")
+describe("sma_loop_lag", "Delay of the event loop in running a scheduled callback")
+describe("sma_recreate", "Container recreate until recreated, running and the player connected to LMS")
+describe("sma_recreate_errors", "Recreated containers not running or connected within the health timeout")
+
+async def main():
+    print('metrics test')
+
+    for i in range(100):
+        with timed("sma_mqtt_handler", handler="set_volume"):
+            await asyncio.sleep(0.001)
+    print(percentiles("sma_mqtt_handler_seconds", "handler"))
+    print(render())
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,65 @@
+#!/usr/bin/python3
+
+# blocking file and USB IO runs on a small dedicated thread pool, so the MQTT reader and the
+# state publishers never wait behind a slow SD card write or a USB reset
+
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+import functools
+
+import compose
+import metrics
+import power
+
+MAX_WORKERS = 2 # a Pi has few cores and the work is IO bound
+
+# operations in flight per kind, writes to the env file are serialized as set_key rewrites the whole file
+LIMITS = {
+    "read_config": 2,
+    "update_config": 1,
+    "usb_reset": 1,
+    "name_files": 1,
+    "backup_files": 1,
+}
+
+nameFilePath = "/etc/opt/squeezelite"
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="offload")
+_limits = {operation: asyncio.Semaphore(limit) for operation, limit in LIMITS.items()}
+
+async def run(operation, fn, *args):
+    async with _limits[operation]:
+        with metrics.timed("sma_offload", operation=operation):
+            return await asyncio.get_running_loop().run_in_executor(_executor, functools.partial(fn, *args))
+
+async def read_config_value(key):
+    return await run("read_config", compose.read_config_value, key)
+
+async def update_config_value(key, value):
+    return await run("update_config", compose.update_config_value, key, value)
+
+async def reset_usb_device(usb_id):
+    return await run("usb_reset", power.reset_usb_device, usb_id)
+
+def _read_name_files(count):
+    names = []
+    for channel in range(1, count+1):
+        with open(f"{nameFilePath}/squeeze{channel}.name") as f:
+            names.append(f.read())
+    return names
+
+async def read_name_files(count):
+    return await run("name_files", _read_name_files, count)
+
+def shutdown():
+    _executor.shutdown(wait=False, cancel_futures=True)
+
+async def main():
+    print('offload test')
+
+    print(await read_config_value("LMS_HOST"))
+    print(await read_name_files(8))
+
+if __name__ == '__main__':
+    asyncio.run(main())
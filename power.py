@@ -5,17 +5,16 @@
 #$ dbus-send --system --print-reply --dest=org.freedesktop.login1 /org/freedesktop/login1 "org.freedesktop.login1.Manager.PowerOff" boolean:true
 #$ dbus-send --system --print-reply --dest=org.freedesktop.login1 /org/freedesktop/login1 "org.freedesktop.login1.Manager.Reboot" boolean:true
 
-from dbus_fast import BusType, Message
-from dbus_fast.aio import MessageBus
+from dbus_fast import Message
 
 import asyncio
 import json
+import systembus
+import usbinventory
 from usb.core import find as finddev
 
 async def power_off():
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
-
-    reply = await bus.call(
+    reply = await systembus.call(
         Message(destination='org.freedesktop.login1',
                 path='/org/freedesktop/login1',
                 interface='org.freedesktop.login1.Manager',
@@ -27,12 +26,8 @@ async def power_off():
     else:
         print("Error powering off")
 
-    bus.disconnect()
-
 async def reboot():
-    bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
-
-    reply = await bus.call(
+    reply = await systembus.call(
         Message(destination='org.freedesktop.login1',
                 path='/org/freedesktop/login1',
                 interface='org.freedesktop.login1.Manager',
@@ -44,15 +39,19 @@ async def reboot():
     else:
         print("Error rebooting")
 
-    bus.disconnect()
-
+# returns a list of (busnum, devnum) of the matching devices
 def get_usb_devices(usb_id):
-    devices = finddev(find_all=True,idVendor=usb_id[0], idProduct=usb_id[1])
-    return devices
+    return usbinventory.find(usb_id)
 
 # https://gist.github.com/PaulFurtado/fce98aef890469f34d51
 def reset_usb_device(usb_id):
-    dev = finddev(idVendor=usb_id[0], idProduct=usb_id[1])
+    # libusb is only opened for the device to reset, looked up by its bus address
+    devices = usbinventory.find(usb_id)
+    if not devices:
+        print("Device not found")
+        return
+    busnum, devnum = devices[0]
+    dev = finddev(bus=busnum, address=devnum)
     if dev is None:
         print("Device not found")
         return
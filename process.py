@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# one runner for all external programs (amixer, alsactl, docker, ssh): every run has a timeout,
+# is killed when it exceeds it, waits for a free slot and is recorded in the metrics
+
+import asyncio
+import collections
+import os
+import time
+
+import metrics
+
+DEFAULT_TIMEOUT = 30 # seconds
+MAX_CONCURRENT = 4 # programs running at the same time, sized for a Pi
+
+_slots = asyncio.Semaphore(MAX_CONCURRENT)
+
+class Result(collections.namedtuple("Result", "program returncode stdout stderr duration timed_out")):
+    @property
+    def ok(self):
+        return self.returncode == 0
+
+    # one line description for error messages
+    def error(self):
+        if self.timed_out:
+            return f"{self.program} timed out after {self.duration:.1f} seconds"
+        if self.returncode is None:
+            return f"{self.program} could not be started: {self.stderr.decode()}"
+        return f"{self.program} exited with {self.returncode}: {self.stderr.decode().strip()}"
+
+# input is written to stdin, alternatively stdin can be a file descriptor that is handed over
+# to the program and closed here once it is started
+async def run(program, input=None, timeout=DEFAULT_TIMEOUT, env=None, stdin=None):
+    name = os.path.basename(program[0])
+    async with _slots:
+        start = time.monotonic()
+        try:
+            try:
+                p = await asyncio.create_subprocess_exec(*program, env=env,
+                    stdin=asyncio.subprocess.PIPE if input is not None else stdin,
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            finally:
+                if isinstance(stdin, int):
+                    os.close(stdin)
+        except OSError as error:
+            metrics.inc("sma_subprocess_errors", program=name)
+            return Result(name, None, b"", str(error).encode(), time.monotonic() - start, False)
+
+        timed_out = False
+        try:
+            stdout, stderr = await asyncio.wait_for(p.communicate(input), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+            p.kill()
+            stdout, stderr = await p.communicate()
+        except asyncio.CancelledError:
+            p.kill()
+            await p.wait()
+            raise
+        duration = time.monotonic() - start
+
+    metrics.observe("sma_subprocess_seconds", duration, program=name)
+    metrics.inc("sma_subprocess_runs", program=name, exit_code=p.returncode)
+    if timed_out:
+        metrics.inc("sma_subprocess_timeouts", program=name)
+    if p.returncode != 0:
+        metrics.inc("sma_subprocess_errors", program=name)
+    return Result(name, p.returncode, stdout, stderr, duration, timed_out)
+
+async def main():
+    print('process test')
+
+    print(await run([ 'echo', 'hello' ]))
+    print(await run([ 'cat' ], input=b"hello"))
+    result = await run([ 'sleep', '10' ], timeout=1)
+    print(result.error())
+    result = await run([ 'does-not-exist' ])
+    print(result.error())
+
+if __name__ == '__main__':
+    asyncio.run(main())
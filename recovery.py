@@ -0,0 +1,162 @@
+#!/usr/bin/python3
+
+# USB DAC recovery sequence as a state machine, each phase returns the next one:
+# mute -> psu_off -> hub_power_off -> hub_power_on -> hub_reset -> enumeration -> psu_on -> unmute
+# phases wait on the actual hotplug events instead of fixed sleeps where the device tells us
+
+import asyncio
+import time
+
+import gpio
+import offload
+import power
+
+ENUMERATION_TIMEOUT = 30 # seconds
+POWER_OFF_TIMEOUT = 5 # seconds
+POWER_OFF_MIN = 1 # seconds, let the hub discharge even if its removal is reported early
+POLL_INTERVAL = 0.5 # seconds, without hotplug events
+
+usb_id_dacs = [0x0d8c, 0x0102]
+usb_id_hub = [0x1a40, 0x0201]
+
+# statistics since supervisor start
+stats = {
+    "count": 0,
+    "outage": None,
+    "phases": {},
+    "result": None,
+}
+
+class DacRecovery:
+    def __init__(self, gpio_usb_power, gpio_relay=None, gpio_mutes=(), psu_power_on_delay=2, num_dacs=2, monitor=None):
+        self.gpio_usb_power = gpio_usb_power
+        self.gpio_relay = gpio_relay
+        self.gpio_mutes = gpio_mutes
+        self.psu_power_on_delay = psu_power_on_delay
+        self.num_dacs = num_dacs
+        self.monitor = monitor
+        self.channels_on = []
+        self.psu_on = False
+        self.enumerated = False
+        self.restored = False
+        # DACs seen before the hub reset, the reset re-enumerates them with a new device number
+        self.stale_dacs = set()
+
+    async def _wait_for(self, action, usb_id, timeout):
+        if self.monitor is None:
+            await asyncio.sleep(min(timeout, POLL_INTERVAL))
+            return False
+        return await self.monitor.wait_for(action, usb_id, timeout)
+
+    async def _wait_present(self, usb_id, count, timeout, exclude=()):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while len(set(power.get_usb_devices(usb_id)) - set(exclude)) < count:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            await self._wait_for("add", usb_id, remaining)
+        return True
+
+    async def mute(self):
+        if self.gpio_mutes:
+            mutes = await gpio.get_many(self.gpio_mutes)
+            self.channels_on = [gpio_mute for gpio_mute, is_on in mutes.items() if is_on]
+        if self.channels_on:
+            await gpio.set_many({gpio_mute: 0 for gpio_mute in self.channels_on})
+        return self.psu_off
+
+    async def psu_off(self):
+        if self.gpio_relay is not None:
+            self.psu_on = bool(await gpio.get(self.gpio_relay))
+            if self.psu_on:
+                await gpio.set(self.gpio_relay, 0)
+        return self.hub_power_off
+
+    async def hub_power_off(self):
+        await gpio.set(self.gpio_usb_power, 0)
+        start = time.monotonic()
+        if self.monitor is not None:
+            await self.monitor.wait_for("remove", usb_id_hub, POWER_OFF_TIMEOUT)
+        else:
+            await asyncio.sleep(POWER_OFF_TIMEOUT)
+        remaining = POWER_OFF_MIN - (time.monotonic() - start)
+        if remaining > 0:
+            await asyncio.sleep(remaining)
+        return self.hub_power_on
+
+    async def hub_power_on(self):
+        await gpio.set(self.gpio_usb_power, 1)
+        if not await self._wait_present(usb_id_hub, 1, ENUMERATION_TIMEOUT):
+            print("USB hub did not enumerate after power on.")
+        return self.hub_reset
+
+    async def hub_reset(self):
+        self.stale_dacs = set(power.get_usb_devices(usb_id_dacs))
+        if self.monitor is not None:
+            self.monitor.clear()
+        await offload.reset_usb_device(usb_id_hub)
+        return self.enumeration
+
+    async def enumeration(self):
+        # right after the reset the old DACs may still be listed, only re-enumerated ones count
+        self.enumerated = await self._wait_present(usb_id_dacs, self.num_dacs, ENUMERATION_TIMEOUT, self.stale_dacs)
+        if not self.enumerated:
+            print(f"USB DACs did not enumerate within {ENUMERATION_TIMEOUT} seconds.")
+        return self.psu_on_phase
+
+    async def psu_on_phase(self):
+        if self.psu_on:
+            await gpio.set(self.gpio_relay, 1)
+            # amplifiers need time to settle before unmuting, there is no event for this
+            await asyncio.sleep(self.psu_power_on_delay)
+        return self.unmute
+
+    async def unmute(self):
+        if self.channels_on:
+            await gpio.set_many({gpio_on: 1 for gpio_on in self.channels_on})
+        self.restored = True
+        return None
+
+    # usb power, power supply and mutes as before the recovery, if it was aborted on the way
+    async def restore(self):
+        try:
+            await gpio.set(self.gpio_usb_power, 1)
+            await self.psu_on_phase()
+            await self.unmute()
+        except Exception as error:
+            print(f'Error "{error}". Could not restore power supply and mutes after USB DAC recovery.')
+
+    # returns True if the DACs are back, phase durations are recorded in stats
+    async def run(self):
+        if self.monitor is not None:
+            # only events caused by the recovery itself are of interest
+            self.monitor.clear()
+        phases = {}
+        start = time.monotonic()
+        phase = self.mute
+        try:
+            while phase is not None:
+                phase_start = time.monotonic()
+                next_phase = await phase()
+                phases[phase.__name__.removesuffix("_phase")] = round(time.monotonic() - phase_start, 3)
+                phase = next_phase
+        finally:
+            # errors and cancellation must not leave the amps muted and without power
+            if not self.restored:
+                await self.restore()
+            stats["count"] += 1
+            stats["outage"] = round(time.monotonic() - start, 3)
+            stats["phases"] = phases
+            stats["result"] = "recovered" if self.enumerated and phase is None else "failed"
+        return self.enumerated
+
+async def main():
+    print('recovery test')
+
+    recovery = DacRecovery(gpio_usb_power=11)
+    print(await recovery.run())
+    print(stats)
+
+if __name__ == '__main__':
+    asyncio.run(main())
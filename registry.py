@@ -0,0 +1,260 @@
+#!/usr/bin/python3
+
+# container registry client to resolve image tags to platform specific digests
+# https://docs.docker.com/registry/spec/api/
+
+import aiohttp
+import asyncio
+import json
+import metrics
+import os
+import re
+import time
+
+from config import cache_dir
+
+MANIFEST_WINDOW = 4 # concurrent manifest requests
+KEEPALIVE_TIMEOUT = 60 # seconds
+TOKEN_EXPIRY_MARGIN = 10 # seconds
+
+MANIFEST_TYPES = ",".join([
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+])
+
+cacheFile = f"{cache_dir}/registry.json"
+
+# release tags are immutable, so their digests can be cached forever
+_RELEASE_TAG = re.compile(r"^v\d+\.\d+\.\d+$")
+
+_platform = None
+_session = None
+# scope -> (token, expiry), expiry is None if the token response has no expires_in
+_tokens = {}
+# manifest url -> (index digest, etag, platform digest)
+_manifests = {}
+
+def get_session():
+    # one keep-alive connection pool for the registry host shared by all requests
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(limit_per_host=MANIFEST_WINDOW,
+            keepalive_timeout=KEEPALIVE_TIMEOUT, ttl_dns_cache=KEEPALIVE_TIMEOUT)
+        _session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=60),
+            trace_configs=[metrics.http_trace_config("registry")])
+    return _session
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+def docker_platform():
+    global _platform
+    if _platform is None:
+        machine = os.uname().machine
+        if machine == "armv7l":
+            _platform = {
+                "architecture": "arm",
+                "os": "linux",
+                "variant": "v7"
+            }
+        elif machine == "aarch64":
+            _platform = {
+                "architecture": "arm64",
+                "os": "linux"
+            }
+    return _platform
+
+def read_cache():
+    try:
+        with open(cacheFile) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def write_cache(cache):
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with open(cacheFile, "w") as f:
+            json.dump(cache, f)
+    except OSError as error:
+        print(f"Error writing registry cache: {error}")
+
+# returns the repository base url and the tag of the image
+def image_repository(image):
+    registry = "ghcr.io"
+    org = "library"
+    tag = "latest"
+    if ":" in image:
+        repo, tag = image.split(":")
+    else:
+        repo = image
+    if "/" in repo:
+        parts = repo.split("/")
+        if len(parts) == 3:
+            registry = parts[0]
+            org = parts[1]
+            repo = parts[2]
+        else:
+            org = parts[0]
+            repo = parts[1]
+
+    return f"https://{registry}/v2/{org}/{repo}", tag
+
+async def get_token(base_url, refresh=False):
+    scope = f"repository:{base_url.split('/v2/', 1)[1]}:pull"
+    token, expiry = _tokens.get(scope, (None, None))
+    if token is None or refresh or (expiry is not None and time.monotonic() >= expiry):
+        url = "https://ghcr.io/token"
+        params = {
+            "service": "ghcr.io",
+            "scope": scope,
+            "client_id": "shell"
+        }
+        async with get_session().get(url, params=params) as response:
+            data = await response.json()
+            token = data["token"]
+        expiry = None
+        if "expires_in" in data:
+            expiry = time.monotonic() + data["expires_in"] - TOKEN_EXPIRY_MARGIN
+        _tokens[scope] = (token, expiry)
+    return token
+
+# returns status, headers and the json body of GET requests with other status than 304
+async def request(method, base_url, url, headers):
+    # ghcr.io tokens have no expires_in, so the cached token is tried first and a new one
+    # is only requested when the registry answers 401
+    for attempt in range(2):
+        token = await get_token(base_url, refresh=attempt > 0)
+        headers = headers | {"Authorization": f"Bearer {token}"}
+        async with get_session().request(method, url, headers=headers) as response:
+            if response.status == 401 and attempt == 0:
+                continue
+            data = None
+            if method == "GET" and response.status != 304:
+                data = await response.json(content_type=None)
+            return response.status, response.headers, data
+
+async def image_digest_remote(base_url, tag):
+    url = f"{base_url}/manifests/{tag}"
+    headers = {
+        "Accept": MANIFEST_TYPES
+    }
+
+    # an unchanged manifest costs one small request: a conditional GET if the
+    # registry sends an ETag, otherwise a HEAD request comparing Docker-Content-Digest
+    cached = _manifests.get(url)
+    if cached is not None:
+        index_digest, etag, platform_digest = cached
+        if etag is not None:
+            headers["If-None-Match"] = etag
+        else:
+            status, response_headers, _ = await request("HEAD", base_url, url, headers)
+            if status == 200 and response_headers.get("Docker-Content-Digest") == index_digest:
+                return platform_digest
+
+    status, response_headers, data = await request("GET", base_url, url, headers)
+    if status == 304:
+        return cached[2]
+    if status != 200 or "errors" in data:
+        return None
+
+    digest = response_headers.get("Docker-Content-Digest")
+    if "manifests" not in data:
+        # single platform image, the manifest itself is the platform manifest
+        platform_digest = digest
+    else:
+        platform = docker_platform()
+        platform_digest = None
+        for manifest in data["manifests"]:
+            if manifest.get("platform") == platform:
+                platform_digest = manifest["digest"]
+                break
+    if platform_digest is not None:
+        _manifests[url] = (digest, response_headers.get("ETag"), platform_digest)
+    return platform_digest
+
+# digest of the tag's manifest (index) as of the last image_digest_remote(), this is the
+# digest docker records in the RepoDigests of an image pulled by tag
+def manifest_digest(base_url, tag):
+    cached = _manifests.get(f"{base_url}/manifests/{tag}")
+    if cached is not None:
+        return cached[0]
+
+# installed_digests are the RepoDigests of the running image, they hold the index digest of the tag
+# it was pulled by, so each release tag is cached with its index and its platform digest
+async def get_image_versions(base_url, installed_digests, remote_digest):
+    url = f"{base_url}/tags/list"
+    versions = []
+    status, headers, data = await request("GET", base_url, url, {})
+    for tag in data.get("tags") or []:
+        if _RELEASE_TAG.match(tag):
+            versions.append(tag[1:])
+
+    # https://stackoverflow.com/a/2574090
+    versions.sort(key=lambda s: [int(u) for u in s.split('.')], reverse=True)
+
+    # only tags that have not been seen before are resolved, with a bounded number of requests in flight
+    cache = read_cache()
+    digests = cache.get(base_url, {})
+    window = asyncio.Semaphore(MANIFEST_WINDOW)
+    async def resolve(tag):
+        async with window:
+            platform_digest = await image_digest_remote(base_url, tag)
+            return [manifest_digest(base_url, tag), platform_digest]
+
+    # entries of older caches are plain platform digests and resolved again
+    new_tags = [f"v{version}" for version in versions if not isinstance(digests.get(f"v{version}"), list)]
+    if new_tags:
+        results = await asyncio.gather(*[resolve(tag) for tag in new_tags], return_exceptions=True)
+        for tag, digest in zip(new_tags, results):
+            if isinstance(digest, Exception):
+                # only errors are retried on the next check, tags without a platform image are cached with None
+                print(f"Error resolving {tag}: {digest}")
+            else:
+                digests[tag] = digest
+        cache[base_url] = digests
+        write_cache(cache)
+
+    local_version = None
+    remote_version = None
+    for version in versions:
+        index_digest, platform_digest = digests.get(f"v{version}") or (None, None)
+        if platform_digest is None:
+            continue
+        if local_version is None and (index_digest in installed_digests or platform_digest in installed_digests):
+            local_version = version
+        if platform_digest == remote_digest and remote_version is None:
+            remote_version = version
+
+    return local_version, remote_version
+
+async def main():
+    print('registry test')
+
+    print(docker_platform())
+
+    image = "ghcr.io/aschamberger/sma-squeezelite"
+    base_url, tag = image_repository(image)
+    remote_digest = await image_digest_remote(base_url, tag)
+    print(remote_digest)
+
+    versions = await get_image_versions(base_url, [manifest_digest(base_url, tag)], remote_digest)
+    print(versions)
+
+    # second check is answered from the token cache and with a conditional request
+    base_url, tag = image_repository(image)
+    print(await image_digest_remote(base_url, tag))
+
+    image = "ghcr.io/aschamberger/sma-squeezelite:main"
+    base_url, tag = image_repository(image)
+    print(await image_digest_remote(base_url, tag))
+
+    await close()
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -2,18 +2,27 @@
 
 import asyncio
 import json
+import re
 import sys
+import tarfile
 import time
-import socket
 
 import aiohttp
 import aiomqtt
 import alsa
 import backup
 import compose
+import discovery
+import docker_engine
 import gpio
-import lms
+import hotplug
+import looplag
+import metrics
+import offload
 import power
+import recovery
+import registry
+import systembus
 from config import (
     discovery_prefix,
     entities,
@@ -25,7 +34,6 @@ from config import (
     subscriptions,
 )
 from pysqueezebox import Server as LmsServer
-from zeroconf import ServiceBrowser, Zeroconf, ServiceStateChange
 
 # publish entities for mqtt discovery
 async def publish_entities(client):
@@ -34,24 +42,24 @@ async def publish_entities(client):
         await client.publish(topic, payload=json.dumps(entity), retain=True)
 
 async def publish_gpio_config(client):
-    relay = compose.read_config_value("GPIO_PSU_RELAY")
-    delay_on = compose.read_config_value("PSU_POWER_ON_DELAY")
-    delay_down = compose.read_config_value("PSU_POWER_DOWN_DELAY")
+    relay = await offload.read_config_value("GPIO_PSU_RELAY")
+    delay_on = await offload.read_config_value("PSU_POWER_ON_DELAY")
+    delay_down = await offload.read_config_value("PSU_POWER_DOWN_DELAY")
     payload = f"{relay};{delay_on};{delay_down}"
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_psu_relay/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("GPIO_PSU_RELAY_OFF_ON_AMP_SHUTDOWN")
+    payload = await offload.read_config_value("GPIO_PSU_RELAY_OFF_ON_AMP_SHUTDOWN")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_mute/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("GPIO_USB_POWER")
+    payload = await offload.read_config_value("GPIO_USB_POWER")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_usb_dac/state"
     await client.publish(topic, payload=payload)
 
     sps = [""]*num_channels
     for channel in range(1, num_channels+1):
-        config = compose.read_config_value(f"GPIO_CH{channel}_SPS")
+        config = await offload.read_config_value(f"GPIO_CH{channel}_SPS")
         if config is not None:
             sps[channel-1] = config
     payload = ";".join(sps)
@@ -59,49 +67,49 @@ async def publish_gpio_config(client):
     await client.publish(topic, payload=payload)
 
 async def publish_backup_config(client):
-    host = compose.read_config_value("BACKUP_SSH_HOST")
-    port = compose.read_config_value("BACKUP_SSH_PORT")
-    user = compose.read_config_value("BACKUP_SSH_USER")
+    host = await offload.read_config_value("BACKUP_SSH_HOST")
+    port = await offload.read_config_value("BACKUP_SSH_PORT")
+    user = await offload.read_config_value("BACKUP_SSH_USER")
     payload = f"{user}@{host}:{port}"
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_host/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("BACKUP_SSH_PASSWORD")
+    payload = await offload.read_config_value("BACKUP_SSH_PASSWORD")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_password/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("BACKUP_SSH_FOLDER")
+    payload = await offload.read_config_value("BACKUP_SSH_FOLDER")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_folder/state"
     await client.publish(topic, payload=payload)
 
 async def publish_hass_config(client):
-    payload = compose.read_config_value("HASS_HOST")
+    payload = await offload.read_config_value("HASS_HOST")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_hass_host/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("HASS_BEARER")
+    payload = await offload.read_config_value("HASS_BEARER")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_hass_bearer/state"
     await client.publish(topic, payload=payload)
 
 async def publish_mqtt_config(client):
-    host = compose.read_config_value("MQTT_HOST")
-    user = compose.read_config_value("MQTT_USER")
+    host = await offload.read_config_value("MQTT_HOST")
+    user = await offload.read_config_value("MQTT_USER")
     payload = f"{user}@{host}"
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_mqtt_host/state"
     await client.publish(topic, payload=payload)
 
-    payload = compose.read_config_value("MQTT_PASSWORD")
+    payload = await offload.read_config_value("MQTT_PASSWORD")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_mqtt_password/state"
     await client.publish(topic, payload=payload)
 
 async def publish_lms_config(client):
-    payload = compose.read_config_value("LMS_HOST")
+    payload = await offload.read_config_value("LMS_HOST")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_lms_host/state"
     await client.publish(topic, payload=payload)
 
 async def publish_hass_switch(client):
     for channel in range(1, num_channels+1):
-        switch = compose.read_config_value(f"HASS_SWITCH_CH{channel}")
+        switch = await offload.read_config_value(f"HASS_SWITCH_CH{channel}")
         topic = f"{discovery_prefix}/text/{node_id}/{node_id}_ch{channel:02d}_hass_switch/state"
         await client.publish(topic, payload=switch)
 
@@ -120,25 +128,27 @@ async def publish_equalizer_settings(client):
             topic = f"{discovery_prefix}/number/{node_id}/{node_id}_ch{channel:02d}_eq{eq_channel_num:02d}_eqsetting/state"
             await client.publish(topic, payload=settings[eq_channel_num])
 
-def get_player_names_from_name_files():
-    path = "/etc/opt/squeezelite"
-    names = []
-    for channel in range(1, num_channels+1):
-        filename = f"{path}/squeeze{channel}.name"
-        with open(filename) as f:
-            names.append(f.read())
-    return names
-
 async def publish_player_names_from_name_files(client):
     path = "/etc/opt/squeezelite"
-    names = get_player_names_from_name_files()
+    names = await offload.read_name_files(num_channels)
     for channel in range(1, num_channels+1):
         topic = f"{discovery_prefix}/text/{node_id}/{node_id}_ch{channel:02d}_player_name/state"
         await client.publish(topic, payload=names[channel-1])
 
+async def publish_states(client):
+    await publish_gpio_config(client)
+    await publish_backup_config(client)
+    await publish_hass_config(client)
+    await publish_mqtt_config(client)
+    await publish_lms_config(client)
+    await publish_hass_switch(client)
+    await publish_volume(client)
+    await publish_equalizer_settings(client)
+    await publish_player_names_from_name_files(client)
+
 async def poll_lms_and_publish_player_names(client, lms_server):
     sleep_interval = 1 # seconds
-    names = get_player_names_from_name_files()
+    names = await offload.read_name_files(num_channels)
     while True:
         try:
             for channel in range(1, num_channels+1):
@@ -158,141 +168,348 @@ async def poll_lms_and_publish_player_names(client, lms_server):
             print(f'Error "{error}". LMS name polling cancelled.')
             break
 
-async def publish_container_states(client):
-    sleep_interval = 1 # seconds
-    supervisor = None
-    channels = [None for element in range(num_channels)]
-    while True:
-        try:
-            container_status = await compose.get_container_status()
-
-            state = "OFF"
-            if 'supervisor' in container_status:
-                if container_status['supervisor'] == 'running':
-                    state = "ON"
+def container_state_topics():
+    topics = {
+        "supervisor": f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_supervisor/state"
+    }
+    for channel in range(1, num_channels+1):
+        topics[f"squeezelite{channel}"] = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_ch{channel:02d}/state"
+        topics[f"hermes{channel}"] = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_ch{channel:02d}_hermes/state"
+    return topics
 
-            if supervisor != state:
-                supervisor = state
-                topic = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_supervisor/state"
-                await client.publish(topic, payload=state)
+async def publish_container_states(client):
+    reconnect_interval = 5 # seconds
+    topics = container_state_topics()
+    states = {}
 
-            for channel in range(1, num_channels+1):
-                container = f"squeezelite{channel}"
-                state = "OFF"
-                if container in container_status:
-                    if container_status[container] == 'running':
-                        state = "ON"
-
-                if channels[channel-1] != state:
-                    channels[channel-1] = state
-                    topic = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_ch{channel:02d}/state"
-                    try:
-                        await client.publish(topic, payload=state)
-                    except aiomqtt.MqttCodeError as error:
-                        print(f'Error "{error}".')
+    async def publish_state(container, container_state):
+        state = "ON" if container_state == 'running' else "OFF"
+        if states.get(container) != state:
+            states[container] = state
+            try:
+                await client.publish(topics[container], payload=state)
+            except aiomqtt.MqttCodeError as error:
+                print(f'Error "{error}".')
 
-            await asyncio.sleep(sleep_interval)
+    while True:
+        try:
+            # resync with a full listing, then only follow the transitions from the event stream
+            since = int(time.time())
+            container_status = await docker_engine.get_container_status()
+            for container in topics:
+                await publish_state(container, container_status.get(container))
+            async for container, container_state in docker_engine.container_events(since):
+                if container in topics:
+                    await publish_state(container, container_state)
+
+        except (aiohttp.ClientError, OSError, ValueError) as error:
+            print(f'Error "{error}". Reconnecting to docker engine in {reconnect_interval} seconds.')
+            await asyncio.sleep(reconnect_interval)
 
         except asyncio.CancelledError as error:
-            print(f'Error "{error}". Container state polling cancelled.')
+            print(f'Error "{error}". Container state watching cancelled.')
             break
 
-async def poll_registry_for_container_updates(client, session):
+# update entity: (compose service, container the installed version is read from)
+update_services = {
+    "supervisor": ("supervisor", "supervisor"),
+    "squeezelite": ("squeezelite_tpl", "squeezelite1"),
+}
+update_states = {}
+# image -> (digest, pull task)
+image_pulls = {}
+# set to check the registry before the polling interval is over, e.g. after an update
+registry_check = asyncio.Event()
+
+async def publish_update_state(client, name, **state):
+    update_states.setdefault(name, {}).update(state)
+    topic = f"{discovery_prefix}/update/{node_id}/{node_id}_update_{name}/state"
+    try:
+        await client.publish(topic, payload=json.dumps(update_states[name]))
+    except aiomqtt.MqttError as error:
+        print(f'Error "{error}".')
+
+async def pull_image(client, name, image):
+    async def progress(percentage):
+        await publish_update_state(client, name, in_progress=True, update_percentage=percentage)
+
+    await publish_update_state(client, name, in_progress=True, update_percentage=0)
+    try:
+        return await compose.image_pull(image, progress)
+    except Exception as error:
+        print(f'Error "{error}" pulling {image}.')
+        return False
+    finally:
+        await publish_update_state(client, name, in_progress=False, update_percentage=None)
+
+# pull in the background, a running or successful pull of the same digest is reused
+def prepull_image(client, name, image, digest=None):
+    if image in image_pulls:
+        pulled_digest, task = image_pulls[image]
+        if not task.done():
+            return task
+        if task.result() and (digest is None or digest == pulled_digest):
+            return task
+    task = asyncio.create_task(pull_image(client, name, image))
+    image_pulls[image] = (digest, task)
+    return task
+
+async def poll_registry_for_container_updates(client):
     sleep_interval = 6*60*60 # seconds
-    services = ["supervisor", "squeezelite_tpl"]
     while True:
         try:
-            for service in services:
-                is_local = await compose.is_local_build(service)
-                if not is_local:
-                    image = await compose.image_from_compose_service(service)
-                    local_digest = await compose.image_digest_local(image)
-                    base_url, tag, token = await compose.image_registry_auth(session, image)
-                    remote_digest = await compose.image_digest_remote(session, base_url, token, tag)
-                    if "latest" in image:
-                        installed, latest = await compose.get_image_versions(session, base_url, token, local_digest, remote_digest)
-                        state = {
-                            "installed_version": installed,
-                            "latest_version": latest,
-                        }
-                    else:
-                        state = {
-                            "installed_version": local_digest,
-                            "latest_version": remote_digest,
-                        }
+            for name, (service, container) in update_services.items():
+                try:
+                    is_local = await compose.is_local_build(service)
+                    if not is_local:
+                        image = await compose.image_from_compose_service(service)
+                        image_id = await compose.container_image_digest(container)
+                        if not image_id:
+                            image_id = await compose.image_digest_local(image)
+                        base_url, tag = registry.image_repository(image)
+                        remote_digest = await registry.image_digest_remote(base_url, tag)
+                        index_digest = registry.manifest_digest(base_url, tag)
+                        # image ids are not registry digests, an image records the digests it was pulled by:
+                        # the running one to tell the installed version, the tagged one if an update is pulled
+                        installed_digests = await compose.image_repo_digests(image_id) if image_id else []
+                        repo_digests = await compose.image_repo_digests(image)
+                        is_pulled = remote_digest in repo_digests or index_digest in repo_digests
+                        if "latest" in image:
+                            installed, latest = await registry.get_image_versions(base_url, installed_digests, remote_digest)
+                            await publish_update_state(client, name, installed_version=installed, latest_version=latest)
+                        else:
+                            is_installed = remote_digest in installed_digests or index_digest in installed_digests
+                            if is_installed:
+                                installed = remote_digest
+                            else:
+                                installed = installed_digests[0] if installed_digests else image_id
+                            await publish_update_state(client, name, installed_version=installed, latest_version=remote_digest)
 
-                    topic = f"{discovery_prefix}/text/{node_id}/{node_id}_update_{service}/state"
-                    await client.publish(topic, payload=json.dumps(state))
+                        # download a newer image right away so the update itself does not need to wait for it
+                        if remote_digest is not None and not is_pulled:
+                            prepull_image(client, name, image, remote_digest)
+                except (aiohttp.ClientError, asyncio.TimeoutError, ValueError, KeyError) as error:
+                    # one failed check must not end the polling, the next interval retries
+                    print(f'Error "{error}" checking {name} for updates.')
 
-            await asyncio.sleep(sleep_interval)
+            try:
+                await asyncio.wait_for(registry_check.wait(), sleep_interval)
+            except asyncio.TimeoutError:
+                pass
+            registry_check.clear()
 
         except asyncio.CancelledError as error:
             print(f'Error "{error}". Container registry polling cancelled.')
             break
 
-async def usb_dac_availability():
-    sleep_interval = 60 # seconds
-    usb_id_dacs = [0x0d8c, 0x0102]
-    usb_id_hub = [0x1a40, 0x0201]
-    if compose.read_config_value("GPIO_USB_POWER") is not None:
-        gpio_usb_power = int(compose.read_config_value("GPIO_USB_POWER"))
-        is_powered = await gpio.get(gpio_usb_power)
+async def publish_recovery_stats(client):
+    topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_usb_recoveries/state"
+    await client.publish(topic, payload=recovery.stats["count"])
+    if recovery.stats["outage"] is not None:
+        topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_usb_outage/state"
+        await client.publish(topic, payload=recovery.stats["outage"])
+        topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_usb_outage/attributes"
+        attributes = {"result": recovery.stats["result"]} | recovery.stats["phases"]
+        await client.publish(topic, payload=json.dumps(attributes))
+
+async def read_recovery_settings():
+    gpio_relay = None
+    value = await offload.read_config_value("GPIO_PSU_RELAY")
+    if value is not None:
+        gpio_relay = int(value)
+    psu_power_on_delay = 2
+    value = await offload.read_config_value("PSU_POWER_ON_DELAY")
+    if value is not None:
+        psu_power_on_delay = int(value)
+    gpio_mutes = await get_gpio_mutes()
+    return gpio_relay, gpio_mutes, psu_power_on_delay
+
+async def usb_dac_availability(client):
+    # with hotplug events the sysfs check is only a fallback for lost events
+    check_interval = 5*60 # seconds
+    poll_interval = 60 # seconds
+    value = await offload.read_config_value("GPIO_USB_POWER")
+    if value is not None:
+        is_powered = await gpio.get(int(value))
         if not is_powered:
-            await gpio.set(gpio_usb_power, 1)
-        while True:
+            await gpio.set(int(value), 1)
+        try:
+            monitor = hotplug.UsbMonitor([recovery.usb_id_dacs, recovery.usb_id_hub])
+        except OSError as error:
+            print(f'Error "{error}". No USB hotplug events, polling every {poll_interval} seconds.')
+            monitor = None
+        await publish_recovery_stats(client)
+        try:
+            while True:
+                try:
+                    if len(power.get_usb_devices(recovery.usb_id_dacs)) < 2:
+                        # settings are read per recovery, changed GPIOs apply without restarting this task
+                        value = await offload.read_config_value("GPIO_USB_POWER")
+                        if value is None:
+                            print("USB DACs missing, no GPIO_USB_POWER to recover them.")
+                        else:
+                            print("USB DACs missing, starting recovery.")
+                            gpio_relay, gpio_mutes, psu_power_on_delay = await read_recovery_settings()
+                            dac_recovery = recovery.DacRecovery(int(value), gpio_relay, gpio_mutes,
+                                psu_power_on_delay, 2, monitor)
+                            try:
+                                await dac_recovery.run()
+                            except Exception as error:
+                                print(f'Error "{error}". USB DAC recovery aborted.')
+                            print(f"USB DAC recovery {recovery.stats['result']} after {recovery.stats['outage']} seconds.")
+                            await publish_recovery_stats(client)
+
+                    if monitor is not None:
+                        await monitor.wait_removal(check_interval)
+                    else:
+                        await asyncio.sleep(poll_interval)
+
+                except asyncio.CancelledError as error:
+                    print(f'Error "{error}". USB DAC availability cancelled.')
+                    break
+
+                except Exception as error:
+                    # e.g. MQTT or D-Bus errors, the next check retries
+                    print(f'Error "{error}".')
+                    await asyncio.sleep(poll_interval)
+        finally:
+            if monitor is not None:
+                monitor.close()
+
+backup_lock = asyncio.Lock()
+# set on every config change, the scheduled backup runs once changes have settled
+config_changed = asyncio.Event()
+# handlers that change backed up files: env file, player names and equalizer controls, volumes
+# are stored in asound.state on every slider move and go with the next scheduled backup
+backed_up_handlers = {
+    "set_lms_host", "set_mqtt_host", "set_mqtt_password", "set_hass_host", "set_hass_bearer",
+    "set_backup_host", "set_backup_password", "set_backup_folder", "set_player_name",
+    "set_eqsetting", "set_eqpreset", "set_hass_switch", "set_gpio_psu_relay", "set_gpio_mute",
+    "set_gpio_usb_dac", "set_gpio_sps",
+}
+
+async def run_backup(client):
+    async with backup_lock:
+        status = await backup.incremental_backup()
+        topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_backup_status/state"
+        await client.publish(topic, payload=status)
+        if status.startswith("uploaded"):
+            keep_daily = int(await offload.read_config_value("BACKUP_KEEP_DAILY") or 7)
+            keep_weekly = int(await offload.read_config_value("BACKUP_KEEP_WEEKLY") or 4)
+            await backup.prune_remote(keep_daily, keep_weekly)
+
+# the task is restarted on every MQTT reconnect, the schedule is kept so that reconnects do not
+# push the next backup back: loop time of the next backup
+backup_schedule = {"next": None}
+
+async def scheduled_backups(client):
+    # hours, 0 only backs up after config changes
+    interval = float(await offload.read_config_value("BACKUP_INTERVAL") or 24)*60*60
+    # minutes without config changes before a backup is made
+    quiet_period = float(await offload.read_config_value("BACKUP_QUIET_PERIOD") or 10)*60
+    loop = asyncio.get_running_loop()
+    if backup_schedule["next"] is None:
+        backup_schedule["next"] = loop.time() + interval
+    while True:
+        try:
             try:
-                dac_devices = power.get_usb_devices(usb_id_dacs)
-                if len(list(dac_devices)) < 2:
-                    channel_on_after_reset = []
-                    # mute all channels
-                    for channel in range(1, num_channels+1):
-                        if compose.read_config_value(f"GPIO_CH{channel}_MUTE") is not None:
-                            gpio_mute = int(compose.read_config_value(f"GPIO_CH{channel}_MUTE"))
-                            is_on = await gpio.get(gpio_mute)
-                            if is_on:
-                                channel_on_after_reset.append(gpio_mute)
-                                await gpio.set(gpio_mute, 0)
-                    # power down PSU
-                    psu_on = 0
-                    if compose.read_config_value("GPIO_PSU_RELAY") is not None:
-                        gpio_relay = int(compose.read_config_value("GPIO_PSU_RELAY"))
-                        psu_on = await gpio.get(gpio_relay)
-                        if psu_on:
-                            await gpio.set(gpio_relay, 0)
-                    # power down+up usb hub and reset
-                    gpio_usb_power = int(compose.read_config_value("GPIO_USB_POWER"))
-                    await gpio.set(gpio_usb_power, 0)
-                    await asyncio.sleep(5)
-                    await gpio.set(gpio_usb_power, 1)
-                    power.reset_usb_device(usb_id_hub)
-                    await asyncio.sleep(5)
-                    # reset GPIOs to on as before reset
-                    if psu_on:
-                        gpio_relay = int(compose.read_config_value("GPIO_PSU_RELAY"))
-                        await gpio.set(gpio_relay, 1)
-                        delay = 2
-                        if compose.read_config_value("PSU_POWER_ON_DELAY") is not None:
-                            delay = int(compose.read_config_value("PSU_POWER_ON_DELAY"))
-                        await asyncio.sleep(delay)
-                    for gpio_on in channel_on_after_reset:
-                        await gpio.set(gpio_on, 1)
-
-                await asyncio.sleep(sleep_interval)
-
-            except asyncio.CancelledError as error:
-                print(f'Error "{error}". USB DAC availability cancelled.')
-                break
+                timeout = max(0, backup_schedule["next"] - loop.time()) if interval else None
+                await asyncio.wait_for(config_changed.wait(), timeout)
+                # wait until there was no change for the quiet period
+                while config_changed.is_set():
+                    config_changed.clear()
+                    try:
+                        await asyncio.wait_for(config_changed.wait(), quiet_period)
+                    except asyncio.TimeoutError:
+                        pass
+            except asyncio.TimeoutError:
+                pass
+
+            if await backup.get_settings() is not None:
+                await run_backup(client)
+            backup_schedule["next"] = loop.time() + interval
+
+        except asyncio.CancelledError as error:
+            print(f'Error "{error}". Scheduled backups cancelled.')
+            break
+
+        except Exception as error:
+            # one failed backup must not end the schedule
+            print(f'Error "{error}". Scheduled backup failed.')
+            backup_schedule["next"] = loop.time() + interval
+
+async def get_gpio_mutes():
+    gpio_mutes = []
+    for channel in range(1, num_channels+1):
+        value = await offload.read_config_value(f"GPIO_CH{channel}_MUTE")
+        if value is not None:
+            gpio_mutes.append(int(value))
+    return gpio_mutes
+
+# channels muted by the mute button to be unmuted on the next press
+muted_by_button = []
+
+async def toggle_channel_mutes(value):
+    global muted_by_button
+    # act on press only
+    if not value:
+        return
+    if muted_by_button:
+        await gpio.set_many({gpio_mute: 1 for gpio_mute in muted_by_button})
+        muted_by_button = []
+    else:
+        mutes = await gpio.get_many(await get_gpio_mutes())
+        muted_by_button = [gpio_mute for gpio_mute, is_on in mutes.items() if is_on]
+        if muted_by_button:
+            await gpio.set_many({gpio_mute: 0 for gpio_mute in muted_by_button})
+
+async def psu_fault(value):
+    if not value:
+        return
+    # mute all channels first to prevent speaker plopp, then cut the power supply
+    gpio_mutes = await get_gpio_mutes()
+    if gpio_mutes:
+        await gpio.set_many({gpio_mute: 0 for gpio_mute in gpio_mutes})
+    relay = await offload.read_config_value("GPIO_PSU_RELAY")
+    if relay is not None:
+        await gpio.set(int(relay), 0)
+
+# env key: (binary sensor, built-in action)
+gpio_inputs = {
+    "GPIO_MUTE_BUTTON": ("gpio_mute_button", toggle_channel_mutes),
+    "GPIO_PSU_FAULT": ("gpio_psu_fault", psu_fault),
+}
+
+async def watch_gpio_input(client, board_number, entity, action):
+    topic = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_{entity}/state"
+    retry_interval = 5 # seconds
+    while True:
+        try:
+            value = await gpio.get(board_number)
+            await client.publish(topic, payload="ON" if value else "OFF")
+            async for value, timestamp in gpio.edge_events(board_number):
+                # a failing publish or action must not end the watching of the next edges
+                try:
+                    await client.publish(topic, payload="ON" if value else "OFF")
+                    if action is not None:
+                        await action(value)
+                except Exception as error:
+                    print(f'Error "{error}". GPIO {board_number} edge not handled.')
+
+        except asyncio.CancelledError as error:
+            print(f'Error "{error}". GPIO {board_number} watching cancelled.')
+            break
+
+        except Exception as error:
+            print(f'Error "{error}". GPIO {board_number} watching again in {retry_interval} seconds.')
+            await asyncio.sleep(retry_interval)
 
 async def power_off_lms_players(lms_server):
     for channel in range(1, num_channels+1):
         await lms_server.async_query("power", "0", player=lms_players[channel-1])
 
 async def publish_container_states_off(client):
-    topic = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_supervisor/state"
-    await client.publish(topic, payload="OFF")
-
-    for channel in range(1, num_channels+1):
-        topic = f"{discovery_prefix}/binary_sensor/{node_id}/{node_id}_ch{channel:02d}/state"
+    for topic in container_state_topics().values():
         await client.publish(topic, payload="OFF")
 
 async def do_shutdown(client, lms_server, payload, channel, eq_channel):
@@ -307,36 +524,161 @@ async def do_restart(client, lms_server, payload, channel, eq_channel):
     await publish_container_states_off(client)
     await power.reboot()
 
+async def wait_for_player(lms_server, channel, timeout, interval=0.5):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    while loop.time() < deadline:
+        result = await lms_server.async_query("connected", "?", player=lms_players[channel-1])
+        if result is not None and int(result.get("_connected", 0)):
+            return True
+        await asyncio.sleep(interval)
+    return False
+
+async def recreate_wave(lms_server, profile, wave, players, timeout):
+    loop = asyncio.get_running_loop()
+    # power off the players of this wave to prevent speaker plopp
+    for service in wave:
+        if service in players:
+            await lms_server.async_query("power", "0", player=lms_players[players[service]-1])
+    started = loop.time()
+    await compose.up(profile, True, *wave)
+    recreated = loop.time() - started
+
+    async def health_gate(service):
+        is_running = await compose.wait_running(service, timeout - recreated)
+        running = loop.time() - started
+        is_connected = True
+        if is_running and service in players:
+            is_connected = await wait_for_player(lms_server, players[service], timeout - running)
+        ready = loop.time() - started
+        metrics.observe("sma_recreate_seconds", recreated, service=service, phase="recreated")
+        if is_running and is_connected:
+            metrics.observe("sma_recreate_seconds", running, service=service, phase="running")
+            metrics.observe("sma_recreate_seconds", ready, service=service, phase="ready")
+            print(f"{service}: recreated in {recreated:.1f}s, running after {running:.1f}s, ready after {ready:.1f}s")
+        else:
+            metrics.inc("sma_recreate_errors", service=service)
+            print(f"{service}: not ready after {ready:.1f}s (running: {is_running}, player connected: {is_connected})")
+
+    await asyncio.gather(*[health_gate(service) for service in wave])
+
+# recreate the containers in waves, each wave waits until its containers run and
+# the players are connected to the LMS again, so most rooms keep playing;
+# with keys only the services referencing one of these env file keys are recreated
+async def recreate_containers(lms_server, profile="on", keys=None):
+    wave_size = max(1, int(await offload.read_config_value("RECREATE_WAVE_SIZE") or 2))
+    timeout = int(await offload.read_config_value("RECREATE_HEALTH_TIMEOUT") or 30)
+    services = await compose.services_of_profile(profile)
+    if not services:
+        # no compose model available, fall back to recreating all at once
+        await power_off_lms_players(lms_server)
+        await compose.up(profile, True)
+        return
+    if keys is not None:
+        affected = set()
+        for key in keys:
+            affected.update(await compose.services_using_config_value(key) or [])
+        if affected:
+            services = [service for service in services if service in affected]
+        else:
+            # the key may reach a container in a way the model does not show, recreate all to be safe
+            print(f"No service is known to use {', '.join(keys)}, recreating all services of profile {profile}")
+
+    players = {f"squeezelite{channel}": channel for channel in range(1, num_channels+1)}
+    services.sort(key=lambda service: [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', service)])
+    started = time.monotonic()
+    for i in range(0, len(services), wave_size):
+        await recreate_wave(lms_server, profile, services[i:i+wave_size], players, timeout)
+    print(f"Rolling recreate of {len(services)} services in waves of {wave_size} took {time.monotonic()-started:.1f}s")
+
 async def do_compose_recreate(client, lms_server, payload, channel, eq_channel):
-    # power off all players to prevent speaker plopp
-    await power_off_lms_players(lms_server)
-    await compose.up("on", True)
+    await recreate_containers(lms_server)
 
 async def do_remote_backup(client, lms_server, payload, channel, eq_channel):
-    await backup.create_local_backup()
-    await backup.copy_backup_to_remote()
-    backup.delete_local_backup()
-
-async def do_update_supervisor(session, lms_server):
-    is_local = await compose.is_local_build("supervisor")
-    if not is_local:
-        # power off all players to prevent speaker plopp
-        await power_off_lms_players(lms_server)
-        # trigger container update
-        await compose.start_update_service("sma-update-supervisor.service")
+    try:
+        await run_backup(client)
+    except (ValueError, OSError) as error:
+        print(f'Error "{error}". Backup failed.')
+
+# writes the files of a backup and applies the mixer settings, containers are not touched
+async def restore_backup(archive=None):
+    archive, files = await backup.load_backup(archive)
+    # equalizer controls are applied through amixer, that updates the controls file the running
+    # players have mapped, replacing the file would only take effect after a recreate
+    equalizers = {}
+    for path, data in files.items():
+        match = re.fullmatch(re.escape(backup.eqPath) + r"/ch(\d+)\D[^/]*", path)
+        if match is not None:
+            settings = alsa.equalizer_settings_from_controls(data)
+            if settings is not None:
+                equalizers[path] = (int(match.group(1)), settings)
+    await offload.run("backup_files", backup.write_files,
+        {path: data for path, data in files.items() if path not in equalizers})
+    # one restore for all mixer settings
+    if any(file.endswith("asound.state") for file in files):
+        await alsa.alsactl_restore()
+    # each channel is applied in one transaction, the file is written as is if that is not possible
+    for path, (channel, settings) in equalizers.items():
+        output = await offload.read_config_value(f"OUTPUT_CH{channel}")
+        if output is None or output[-3:] != '_eq' or await alsa.set_equalizer(channel, settings) is None:
+            await offload.run("backup_files", backup.write_files, {path: files[path]})
+    print(f"Restored {len(files)} files from backup {archive}.")
+    return archive
+
+async def do_restore_backup(client, lms_server, payload, channel, eq_channel):
+    topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_backup_status/state"
+    async with backup_lock:
+        try:
+            archive = await restore_backup()
+        except (ValueError, OSError, tarfile.TarError) as error:
+            print(f'Error "{error}". Backup not restored.')
+            await client.publish(topic, payload="restore failed")
+            return
+    await client.publish(topic, payload=f"restored {archive}")
+    # one recreate of all containers and one republish of all states for the restored config
+    await recreate_containers(lms_server)
+    await publish_states(client)
+
+# update entity -> running update, an update runs in the background so that commands
+# are handled while the image is downloaded
+update_tasks = {}
+
+async def run_update(client, lms_server, name, service_name):
+    try:
+        service, container = update_services[name]
+        is_local = await compose.is_local_build(service)
+        if not is_local:
+            # make sure the image is downloaded while the players are still playing
+            image = await compose.image_from_compose_service(service)
+            if not await prepull_image(client, name, image):
+                print(f"Error: image {image} could not be pulled, update cancelled.")
+                return
+            # power off all players to prevent speaker plopp
+            await power_off_lms_players(lms_server)
+            # trigger container update
+            await compose.start_update_service(service_name)
+        # check the registry again to publish the latest version state
+        registry_check.set()
+    except Exception as error:
+        print(f'Error "{error}". Update of {name} failed.')
+
+def start_update(client, lms_server, name, service_name):
+    task = update_tasks.get(name)
+    if task is not None and not task.done():
+        print(f"Update of {name} is already running.")
+        return
+    update_tasks[name] = asyncio.create_task(run_update(client, lms_server, name, service_name))
 
-async def do_update_squeezelite(session, lms_server):
-    is_local = await compose.is_local_build("squeezelite")
-    if not is_local:
-        # power off all players to prevent speaker plopp
-        await power_off_lms_players(lms_server)
-        # trigger container update
-        await compose.start_update_service("sma-update-squeezelite.service")
+async def do_update_supervisor(client, lms_server, payload, channel, eq_channel):
+    start_update(client, lms_server, "supervisor", "sma-update-supervisor.service")
+
+async def do_update_squeezelite(client, lms_server, payload, channel, eq_channel):
+    start_update(client, lms_server, "squeezelite", "sma-update-squeezelite.service")
 
 async def set_lms_host(client, lms_server, payload, channel, eq_channel):
     if (":" not in payload):
         payload = f"{payload}:9000"
-    compose.update_config_value("LMS_HOST", payload)
+    await offload.update_config_value("LMS_HOST", payload)
     # restart players
     await compose.up("on", True)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_lms_host/state"
@@ -350,8 +692,8 @@ async def set_mqtt_host(client, lms_server, payload, channel, eq_channel):
     else:
         user = ""
         host = payload
-    compose.update_config_value("MQTT_HOST", host)
-    compose.update_config_value("MQTT_USER", user)
+    await offload.update_config_value("MQTT_HOST", host)
+    await offload.update_config_value("MQTT_USER", user)
     # restart players
     # TODO: not required for squeezelite instances, so maybe split into two profiles later
     # await compose.up("on", True)
@@ -359,23 +701,23 @@ async def set_mqtt_host(client, lms_server, payload, channel, eq_channel):
     await client.publish(topic, payload=payload)
 
 async def set_mqtt_password(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("MQTT_PASSWORD", payload)
+    await offload.update_config_value("MQTT_PASSWORD", payload)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_mqtt_password/state"
     await client.publish(topic, payload=payload)
 
 async def set_hass_host(client, lms_server, payload, channel, eq_channel):
     if (":" not in payload):
         payload = f"{payload}:8123"
-    compose.update_config_value("HASS_HOST", payload)
+    await offload.update_config_value("HASS_HOST", payload)
     # restart players
-    await compose.up("on", True)
+    await recreate_containers(lms_server)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_hass_host/state"
     await client.publish(topic, payload=payload)
 
 async def set_hass_bearer(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("HASS_BEARER", payload)
+    await offload.update_config_value("HASS_BEARER", payload)
     # restart players
-    await compose.up("on", True)
+    await recreate_containers(lms_server)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_hass_bearer/state"
     await client.publish(topic, payload=payload)
 
@@ -385,19 +727,19 @@ async def set_backup_host(client, lms_server, payload, channel, eq_channel):
         payload = f"{payload}:22"
     user, host = payload.split('@')
     host, port = host.split(':')
-    compose.update_config_value("BACKUP_SSH_HOST", host)
-    compose.update_config_value("BACKUP_SSH_PORT", port)
-    compose.update_config_value("BACKUP_SSH_USER", user)
+    await offload.update_config_value("BACKUP_SSH_HOST", host)
+    await offload.update_config_value("BACKUP_SSH_PORT", port)
+    await offload.update_config_value("BACKUP_SSH_USER", user)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_host/state"
     await client.publish(topic, payload=payload)
 
 async def set_backup_password(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("BACKUP_SSH_PASSWORD", payload)
+    await offload.update_config_value("BACKUP_SSH_PASSWORD", payload)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_password/state"
     await client.publish(topic, payload=payload)
 
 async def set_backup_folder(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("BACKUP_SSH_FOLDER", payload)
+    await offload.update_config_value("BACKUP_SSH_FOLDER", payload)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_backup_folder/state"
     await client.publish(topic, payload=payload)
 
@@ -410,9 +752,9 @@ async def set_player_name(client, lms_server, payload, channel, eq_channel):
 async def check_and_enable_eq(channel):
     # OUTPUT_CH1=ch1_eq
     config_name = f"OUTPUT_CH{channel}"
-    current_config = compose.read_config_value(config_name)
+    current_config = await offload.read_config_value(config_name)
     if current_config[-3:] != '_eq':
-        compose.update_config_value(config_name, f"ch{channel}_eq")
+        await offload.update_config_value(config_name, f"ch{channel}_eq")
         await compose.up("on", True, f"squeezelite{channel}")
 
 async def set_eqsetting(client, lms_server, payload, channel, eq_channel):
@@ -439,7 +781,7 @@ async def set_volume(client, lms_server, payload, channel, eq_channel):
     await client.publish(topic, payload=payload)
 
 async def set_hass_switch(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value(f"HASS_SWITCH_CH{channel}", payload)
+    await offload.update_config_value(f"HASS_SWITCH_CH{channel}", payload)
     await compose.up("on", True, f"squeezelite{channel}")
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_ch{channel:02d}_hass_switch/state"
     await client.publish(topic, payload=payload)
@@ -450,29 +792,30 @@ async def set_gpio_psu_relay(client, lms_server, payload, channel, eq_channel):
         psu = psu[:3]
     if len(psu) < 3:
         psu = psu + [""]*(3-len(psu))
-    compose.update_config_value("GPIO_PSU_RELAY", psu[0])
-    compose.update_config_value("PSU_POWER_ON_DELAY", psu[1])
-    compose.update_config_value("PSU_POWER_DOWN_DELAY", psu[2])
-    await compose.up("on", True)
+    await offload.update_config_value("GPIO_PSU_RELAY", psu[0])
+    await offload.update_config_value("PSU_POWER_ON_DELAY", psu[1])
+    await offload.update_config_value("PSU_POWER_DOWN_DELAY", psu[2])
+    await recreate_containers(lms_server, keys=["GPIO_PSU_RELAY", "PSU_POWER_ON_DELAY", "PSU_POWER_DOWN_DELAY"])
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_psu_relay/state"
     await client.publish(topic, payload=payload)
 
 async def set_gpio_mute(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("GPIO_PSU_RELAY_OFF_ON_AMP_SHUTDOWN", payload)
+    await offload.update_config_value("GPIO_PSU_RELAY_OFF_ON_AMP_SHUTDOWN", payload)
     mute = payload.split(";")
     if len(mute) > num_channels:
         mute = mute[:num_channels]
     if len(mute) < num_channels:
         mute = mute + [""]*(num_channels-len(mute))
     for channel in range(1, num_channels+1):
-        compose.update_config_value(f"GPIO_CH{channel}_MUTE", mute[channel-1])
-    await compose.up("on", True)
+        await offload.update_config_value(f"GPIO_CH{channel}_MUTE", mute[channel-1])
+    keys = ["GPIO_PSU_RELAY_OFF_ON_AMP_SHUTDOWN"] + [f"GPIO_CH{channel}_MUTE" for channel in range(1, num_channels+1)]
+    await recreate_containers(lms_server, keys=keys)
 
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_mute/state"
     await client.publish(topic, payload=";".join(mute))
 
 async def set_gpio_usb_dac(client, lms_server, payload, channel, eq_channel):
-    compose.update_config_value("GPIO_USB_POWER", payload)
+    await offload.update_config_value("GPIO_USB_POWER", payload)
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_usb_dac/state"
     await client.publish(topic, payload=payload)
 
@@ -483,25 +826,78 @@ async def set_gpio_sps(client, lms_server, payload, channel, eq_channel):
     if len(sps) < num_channels:
         sps = sps + [""]*(num_channels-len(sps))
     for channel in range(1, num_channels+1):
-        compose.update_config_value(f"GPIO_CH{channel}_SPS", sps[channel-1])
-    await compose.up("on", True)
+        await offload.update_config_value(f"GPIO_CH{channel}_SPS", sps[channel-1])
+    await recreate_containers(lms_server, keys=[f"GPIO_CH{channel}_SPS" for channel in range(1, num_channels+1)])
 
     topic = f"{discovery_prefix}/text/{node_id}/{node_id}_gpio_sps/state"
     await client.publish(topic, payload=";".join(sps))
 
+async def publish_diagnostics(client, lag_monitor):
+    sleep_interval = 60 # seconds
+    while True:
+        try:
+            summary = metrics.percentiles("sma_mqtt_handler_seconds", "handler")
+            for p in ("p50", "p99"):
+                # state is the slowest handler, attributes per handler in milliseconds
+                values = {handler: round(1000*ps[p], 1) for handler, ps in summary.items() if ps[p] is not None}
+                if values:
+                    topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_latency_{p}"
+                    await client.publish(f"{topic}/state", payload=max(values.values()))
+                    await client.publish(f"{topic}/attributes", payload=json.dumps(values))
+            topic = f"{discovery_prefix}/sensor/{node_id}/{node_id}_loop_lag/state"
+            await client.publish(topic, payload=round(1000*lag_monitor.take_max(), 1))
+
+            await asyncio.sleep(sleep_interval)
+
+        except aiomqtt.MqttError as error:
+            print(f'Error "{error}".')
+            await asyncio.sleep(sleep_interval)
+
+        except asyncio.CancelledError as error:
+            print(f'Error "{error}". Diagnostics publishing cancelled.')
+            break
+
+# maps e.g. homeassistant/number/<node_id>/<node_id>_ch01_eq03_eqsetting/set to
+# ("set_eqsetting", 1, 3), channel and eq_channel are None if not part of the topic
+def parse_topic(topic):
+    topic_levels = topic.split('/')
+    cmd = topic_levels[-1] # 'do' or 'set'
+    object_id = topic_levels[-2]
+    action = object_id[len(node_id)+1:] # remove node_id from beginning
+    channel = None
+    eq_channel = None
+    # extract channel if action on channel
+    if action[0:2] == 'ch' and action[4:5] == '_':
+        channel = int(action[2:4])
+        action = action[5:]
+        # extract eq_channel if action on eq_channel
+        if action[0:2] == 'eq' and action[4:5] == '_':
+            eq_channel = int(action[2:4])
+            action = action[5:]
+    return f"{cmd}_{action}", channel, eq_channel
+
 async def main():
     await compose.image_prune()
-    session = aiohttp.ClientSession()
+    session = aiohttp.ClientSession(trace_configs=[metrics.http_trace_config("lms")])
+    # METRICS_PORT=0 disables the OpenMetrics endpoint
+    metrics_runner = await metrics.start_server(int(await offload.read_config_value("METRICS_PORT") or 9101))
+    lag_monitor = looplag.LagMonitor()
+    lag_task = asyncio.create_task(lag_monitor.run())
+    # LOOP_BLOCKING_THRESHOLD in ms prints the stack of every call blocking the loop for longer
+    blocking_detector = None
+    threshold = await offload.read_config_value("LOOP_BLOCKING_THRESHOLD")
+    if threshold:
+        blocking_detector = looplag.BlockingDetector(int(threshold)/1000)
 
     reconnect_interval = 5 # seconds
     background_tasks = set() # Add task to the set. This creates a strong reference.
     while True:
         try:
-            lms_host, lms_port = compose.read_config_value('LMS_HOST').split(':')
+            lms_host, lms_port = (await offload.read_config_value('LMS_HOST')).split(':')
             lms_server = LmsServer(session, lms_host, int(lms_port))
-            mqtt_host, mqtt_port = compose.read_config_value('MQTT_HOST').split(':')
-            mqtt_user = compose.read_config_value('MQTT_USER')
-            mqtt_password = compose.read_config_value('MQTT_PASSWORD')
+            mqtt_host, mqtt_port = (await offload.read_config_value('MQTT_HOST')).split(':')
+            mqtt_user = await offload.read_config_value('MQTT_USER')
+            mqtt_password = await offload.read_config_value('MQTT_PASSWORD')
             async with aiomqtt.Client(hostname=mqtt_host, port=int(mqtt_port), username=mqtt_user, password=mqtt_password) as client:
                 await publish_entities(client)
                 await publish_gpio_config(client)
@@ -516,10 +912,21 @@ async def main():
                 await publish_player_names_from_name_files(client)
 
                 # make sure usb dacs are available
-                task4 = asyncio.create_task(usb_dac_availability())
+                task4 = asyncio.create_task(usb_dac_availability(client))
                 background_tasks.add(task4)
                 task4.add_done_callback(background_tasks.discard)
 
+                # publish gpio inputs and run the built-in actions on their edge events
+                actions_enabled = await offload.read_config_value("GPIO_INPUT_ACTIONS") != "0"
+                for key, (entity, action) in gpio_inputs.items():
+                    value = await offload.read_config_value(key)
+                    if value is not None:
+                        board_number = int(value)
+                        task = asyncio.create_task(watch_gpio_input(client, board_number, entity,
+                            action if actions_enabled else None))
+                        background_tasks.add(task)
+                        task.add_done_callback(background_tasks.discard)
+
                 # dac availability must be run once before to make sure we have proper input
                 await asyncio.sleep(20)
                 await publish_volume(client)
@@ -530,16 +937,26 @@ async def main():
                 background_tasks.add(task1)
                 task1.add_done_callback(background_tasks.discard)
 
-                # pick up container states via polling
+                # pick up container states via docker engine events
                 task2 = asyncio.create_task(publish_container_states(client))
                 background_tasks.add(task2)
                 task2.add_done_callback(background_tasks.discard)
 
                 # pick up new container versions via polling container registry
-                task3 = asyncio.create_task(poll_registry_for_container_updates(client, session))
+                task3 = asyncio.create_task(poll_registry_for_container_updates(client))
                 background_tasks.add(task3)
                 task3.add_done_callback(background_tasks.discard)
 
+                # handler latency percentiles and loop lag for home assistant
+                task6 = asyncio.create_task(publish_diagnostics(client, lag_monitor))
+                background_tasks.add(task6)
+                task6.add_done_callback(background_tasks.discard)
+
+                # back up on an interval and after config changes
+                task5 = asyncio.create_task(scheduled_backups(client))
+                background_tasks.add(task5)
+                task5.add_done_callback(background_tasks.discard)
+
                 for subscription in subscriptions:
                     await client.subscribe(subscription)
                 # subscribe to 'homeassistant/status'
@@ -548,56 +965,25 @@ async def main():
                     # republish all data when homeassistant/status online
                     if message.topic.matches("homeassistant/status"):
                         if message.payload.decode() == "online":
-                            await publish_gpio_config(client)
-                            await publish_backup_config(client)
-                            await publish_hass_config(client)
-                            await publish_mqtt_config(client)
-                            await publish_lms_config(client)
-                            await publish_hass_switch(client)
-                            await publish_volume(client)
-                            await publish_equalizer_settings(client)
-                            await publish_player_names_from_name_files(client)
+                            await publish_states(client)
                     else:
                         # handle subscriptions and map to function calls
-                        topic_levels = str(message.topic).split('/')
-                        cmd = topic_levels[-1] # 'do' or 'set'
-                        object_id = topic_levels[-2]
-                        action = object_id[len(node_id)+1:] # remove node_id from beginning
-                        channel = None
-                        eq_channel = None
-                        # extract channel if action on channel
-                        if action[0:2] == 'ch' and action[4:5] == '_':
-                            channel = int(action[2:4])
-                            action = action[5:]
-                            # extract eq_channel if action on eq_channel
-                            if action[0:2] == 'eq' and action[4:5] == '_':
-                                eq_channel = int(action[2:4])
-                                action = action[5:]
-
-                        # call desired function
-                        function = f"{cmd}_{action}"
+                        function, channel, eq_channel = parse_topic(str(message.topic))
                         fn = globals().get(function)
                         if fn:
                             # cancel all background tasks before restart/shutdown
                             if function == "do_restart" or function == "do_shutdown":
                                 for task in background_tasks:
                                     task.cancel()
-                            # special handling of container update functions
-                            if function == "do_update_squeezelite" or function == "do_update_supervisor":
-                                await fn(session, lms_server)
-                            else:
+                            with metrics.timed("sma_mqtt_handler", handler=function):
                                 await fn(client, lms_server, message.payload.decode(), channel, eq_channel)
+                            if function in backed_up_handlers:
+                                config_changed.set()
                             # cancel all tasks and reconnect
                             if function == "set_lms_host" or function == "set_mqtt_host":
                                 for task in background_tasks:
                                     task.cancel()
                                 continue
-                            if function == "do_update_squeezelite" or function == "do_update_supervisor":
-                                # restart version checking to publish latest version state
-                                task3.cancel()
-                                task3 = asyncio.create_task(poll_registry_for_container_updates(client, session))
-                                background_tasks.add(task3)
-                                task3.add_done_callback(background_tasks.discard)
                         else:
                             print(f'Error: function {function} does not exist.')
 
@@ -607,67 +993,79 @@ async def main():
             print(f'Error "{error}". Reconnecting in {reconnect_interval} seconds.')
             await asyncio.sleep(reconnect_interval)
 
+    await docker_engine.close()
+    await registry.close()
+    await systembus.disconnect()
     await session.close()
-
-def find_mqtt_service(self, zeroconf, service_type, name, state_change):
-    info = zeroconf.get_service_info(service_type, name)
-    if not (service_type == "_mqtt._tcp.local."):
-        return
-
-    if state_change is ServiceStateChange.Added:
-        host = str(socket.inet_ntoa(info.address))
-        port = info.port
-        compose.update_config_value('MQTT_HOST', f"{host}:{port}")
-    elif state_change is ServiceStateChange.Removed:
-        pass
+    if metrics_runner is not None:
+        await metrics_runner.cleanup()
+    lag_task.cancel()
+    offload.shutdown()
+    if blocking_detector is not None:
+        blocking_detector.stop()
 
 async def set_up_gpios():
-    if compose.read_config_value("GPIO_USB_POWER") is not None:
-        board_number = int(compose.read_config_value("GPIO_USB_POWER"))
+    value = await offload.read_config_value("GPIO_USB_POWER")
+    if value is not None:
+        board_number = int(value)
         await gpio.init(board_number, "output", False, 1)
-    if compose.read_config_value("GPIO_PSU_RELAY") is not None:
-        board_number = int(compose.read_config_value("GPIO_PSU_RELAY"))
+    value = await offload.read_config_value("GPIO_PSU_RELAY")
+    if value is not None:
+        board_number = int(value)
         await gpio.init(board_number, "output")
-    for channel in range(1, num_channels+1):
-        if compose.read_config_value(f"GPIO_CH{channel}_MUTE") is not None:
-            board_number = int(compose.read_config_value(f"GPIO_CH{channel}_MUTE"))
-            await gpio.init(board_number, "output", True)  
-
-if __name__ == '__main__':
-    print('Starting supervisor')
-
+    # request all channel mutes at once, so they can be read/written with one call
+    board_numbers = await get_gpio_mutes()
+    if board_numbers:
+        await gpio.init_lines(board_numbers, "output", True)
+    # inputs switch to ground, debounce period is configured in ms
+    debounce = int(await offload.read_config_value("GPIO_INPUT_DEBOUNCE") or 10)
+    for key in gpio_inputs:
+        value = await offload.read_config_value(key)
+        if value is not None:
+            board_number = int(value)
+            await gpio.init_lines([board_number], "input", True, None, "both", debounce*1000, "pull-up")
+
+async def set_up_endpoints():
+    # add default ports to manually configured hosts
+    mqtt_host = await offload.read_config_value('MQTT_HOST')
+    if mqtt_host is not None and ':' not in mqtt_host:
+        await offload.update_config_value('MQTT_HOST', f"{mqtt_host}:1883")
+    lms_host = await offload.read_config_value('LMS_HOST')
+    if lms_host is not None and ':' not in lms_host:
+        await offload.update_config_value('LMS_HOST', f"{lms_host}:9000")
+
+    # discover MQTT and LMS concurrently if not configured
+    if mqtt_host is None or lms_host is None:
+        endpoints = await discovery.discover(lms=lms_host is None, mqtt=mqtt_host is None)
+        if mqtt_host is None:
+            if endpoints["mqtt"] is None:
+                sys.exit('No mqtt broker could be discovered via zeroconf and no config given manually')
+            await offload.update_config_value('MQTT_HOST', endpoints["mqtt"])
+        if lms_host is None:
+            if endpoints["lms"] is None:
+                sys.exit('No Logitech Media Server could be discovered and no config given manually')
+            await offload.update_config_value('LMS_HOST', endpoints["lms"])
+
+async def start():
     # set up GPIOs
-    asyncio.run(set_up_gpios())
-
-    # discover MQTT
-    if compose.read_config_value('MQTT_HOST') is not None:
-        mqtt_host = compose.read_config_value('MQTT_HOST').split(':')
-        if len(mqtt_host) == 1:
-            mqtt_host.append(1883)
-            compose.update_config_value('MQTT_HOST', ':'.join(mqtt_host))
-    else:
-        zeroconf = Zeroconf()
-        browser = ServiceBrowser(zeroconf, "_mqtt._tcp.local.", handlers=[find_mqtt_service])
-        time.sleep(5)
-        zeroconf.close()
-        if compose.read_config_value('MQTT_HOST') is None:
-            sys.exit('No mqtt broker could be discovered via zeroconf and no config given manually')
-
-    # discover LMS
-    if compose.read_config_value('LMS_HOST') is not None:
-        lms_host = compose.read_config_value('LMS_HOST').split(':')
-        if len(lms_host) == 1:
-            lms_host.append(9000)
-            compose.update_config_value('LMS_HOST', ':'.join(lms_host))
-    else:
-        servers = lms.discover()
-        if len(servers) == 0:
-            sys.exit('No Logitech Media Server could be discovered and no config given manually')
-        else:
-            lms_host = [servers[0]['host'], servers[0]['json']]
-            compose.update_config_value('LMS_HOST', ':'.join(lms_host))
+    await set_up_gpios()
+    await set_up_endpoints()
 
     #pretty = json.dumps(entities, indent=4)
     #print(pretty)
 
-    asyncio.run(main())
\ No newline at end of file
+    await main()
+
+async def restore_cli(archive=None):
+    await restore_backup(archive)
+    await compose.up("on", True)
+
+if __name__ == '__main__':
+    # supervisor.py restore [archive]: restore a local or remote backup archive, default is the latest remote one
+    if sys.argv[1:2] == ["restore"]:
+        asyncio.run(restore_cli(*sys.argv[2:3]))
+        sys.exit()
+
+    print('Starting supervisor')
+
+    asyncio.run(start())
@@ -0,0 +1,51 @@
+#!/usr/bin/python3
+
+# process wide connection to the D-Bus system bus shared by gpio, power and compose
+
+from dbus_fast import BusType
+from dbus_fast.aio import MessageBus
+
+import asyncio
+import metrics
+
+_bus = None
+_lock = asyncio.Lock()
+# coroutine functions called with the bus after each (re)connect, e.g. to add signal matches
+_connect_callbacks = []
+
+def on_connect(callback):
+    _connect_callbacks.append(callback)
+
+async def get_bus():
+    global _bus
+    async with _lock:
+        # lazy connect on first use and reconnect if the bus got lost
+        if _bus is None or not _bus.connected:
+            _bus = await MessageBus(bus_type=BusType.SYSTEM).connect()
+            for callback in _connect_callbacks:
+                await callback(_bus)
+    return _bus
+
+async def call(message):
+    with metrics.timed("sma_dbus_call", member=message.member):
+        bus = await get_bus()
+        try:
+            return await bus.call(message)
+        except Exception:
+            if bus.connected:
+                raise
+            # connection got lost while waiting for the reply, retry once on a new connection
+            bus = await get_bus()
+            return await bus.call(message)
+
+async def disconnect():
+    global _bus
+    async with _lock:
+        if _bus is not None:
+            if _bus.connected:
+                _bus.disconnect()
+                try:
+                    await _bus.wait_for_disconnect()
+                except Exception as error:
+                    print(f"Error disconnecting from system bus: {error}")
+            _bus = None
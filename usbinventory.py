@@ -0,0 +1,81 @@
+#!/usr/bin/python3
+
+# USB device inventory from sysfs, presence checks cost a few small file reads
+# instead of opening libusb and walking the whole bus
+# https://www.kernel.org/doc/Documentation/ABI/stable/sysfs-bus-usb
+
+import os
+
+# SYSFS_USB_DEVICES allows to run against a fake sysfs tree
+sysfsUsbDevices = os.environ.get("SYSFS_USB_DEVICES", "/sys/bus/usb/devices")
+
+class UsbInventory:
+    def __init__(self, root=sysfsUsbDevices):
+        self.root = root
+        # device name -> (inode, [idVendor, idProduct], busnum, devnum)
+        self.devices = {}
+
+    def _read_device(self, name):
+        path = f"{self.root}/{name}"
+        with open(f"{path}/idVendor") as f:
+            vendor = int(f.read(), 16)
+        with open(f"{path}/idProduct") as f:
+            product = int(f.read(), 16)
+        with open(f"{path}/busnum") as f:
+            busnum = int(f.read())
+        with open(f"{path}/devnum") as f:
+            devnum = int(f.read())
+        return [vendor, product], busnum, devnum
+
+    def refresh(self):
+        # only new or re-created entries are read, a re-enumerated device gets a new sysfs inode
+        present = {}
+        try:
+            entries = list(os.scandir(self.root))
+        except OSError as error:
+            print(f"Error reading USB devices: {error}")
+            entries = []
+        for entry in entries:
+            # interfaces (1-1:1.0) have no device ids
+            if ":" in entry.name:
+                continue
+            inode = entry.inode()
+            cached = self.devices.get(entry.name)
+            if cached is not None and cached[0] == inode:
+                present[entry.name] = cached
+                continue
+            try:
+                usb_id, busnum, devnum = self._read_device(entry.name)
+            except (OSError, ValueError):
+                # device vanished while reading
+                continue
+            present[entry.name] = (inode, usb_id, busnum, devnum)
+        self.devices = present
+
+    # returns a list of (busnum, devnum) of the matching devices
+    def find(self, usb_id):
+        self.refresh()
+        return [(busnum, devnum) for _, device_id, busnum, devnum in self.devices.values() if device_id == usb_id]
+
+    def count(self, usb_id):
+        return len(self.find(usb_id))
+
+_inventory = UsbInventory()
+
+def find(usb_id):
+    return _inventory.find(usb_id)
+
+def count(usb_id):
+    return _inventory.count(usb_id)
+
+def main():
+    print('usb inventory test')
+
+    usb_id_dacs = [0x0d8c, 0x0102]
+    usb_id_hub = [0x1a40, 0x0201]
+
+    print(find(usb_id_dacs))
+    print(count(usb_id_hub))
+
+if __name__ == '__main__':
+    main()